@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Author: Gabriel Bustamante
+Email: gabrielbusta@gmail.com
+
+Selfdriving GoPiGo: An open source self-driving robot application.
+This app was built using the GoPiGo robotics platform for the Raspberry Pi.
+
+Copyright (C) 2017 Gabriel Bustamante
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import settings
+from plumbum import colors
+from cvutils import Analysis
+from recording import ReplayCapture, index_path
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+IMAGES = ['images/80.jpeg',
+          'images/100.jpeg',
+          'images/120.jpeg',
+          'images/stop.jpeg']
+
+
+def load_frames(paths):
+    # The bundled images are small squares; scale them to the camera
+    # resolution so buffer sizes match what the car actually streams.
+    frames = []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            logger.warn(colors.yellow & colors.bold |
+                        'Could not read {}'.format(path))
+            continue
+        frames.append(cv2.resize(image, settings.CAMERA_RESOLUTION))
+    return frames
+
+
+def load_clip(path, max_frames):
+    # Recordings made with recording.StreamRecorder carry an index and
+    # may be raw luma, so they are read back through ReplayCapture.
+    if os.path.exists(index_path(path)):
+        clip = ReplayCapture(path, 'fast')
+    else:
+        clip = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < max_frames:
+        reading, frame = clip.read()
+        if not reading:
+            break
+        frames.append(frame)
+    clip.release()
+    if not frames:
+        logger.warn(colors.yellow & colors.bold |
+                    'Could not read any frames from {}'.format(path))
+    return frames
+
+
+def create_analysis(shape, preallocate=True):
+    # Same sign search configuration the car uses, but with every stage
+    # run on every frame so each one can be timed on its own.
+    return Analysis(shape,
+                    'stop-sign-haar-cascade.xml',
+                    'speed-sign-haar-cascade.xml',
+                    preallocate=preallocate,
+                    stop_roi=settings.STOP_SIGN_ROI,
+                    stop_min_size=settings.STOP_SIGN_MIN_SIZE,
+                    stop_max_size=settings.STOP_SIGN_MAX_SIZE,
+                    stop_downscale=settings.STOP_SIGN_DOWNSCALE,
+                    speed_roi=settings.SPEED_SIGN_ROI,
+                    speed_min_size=settings.SPEED_SIGN_MIN_SIZE,
+                    speed_max_size=settings.SPEED_SIGN_MAX_SIZE,
+                    speed_downscale=settings.SPEED_SIGN_DOWNSCALE)
+
+
+STAGES = ['gray_scale',
+          'gaussian_blur',
+          'detect_lanes',
+          'fit_lanes',
+          'detect_speed_signs',
+          'detect_stop_signs',
+          'frame']
+
+
+def timed(timings, stage, function, *args):
+    start = time.perf_counter_ns()
+    result = function(*args)
+    timings[stage].append(time.perf_counter_ns() - start)
+    return result
+
+
+def run_stages(analysis, frame, timings):
+    start = time.perf_counter_ns()
+    grayed = timed(timings, 'gray_scale', analysis.gray_scale, frame)
+    blurred = timed(timings, 'gaussian_blur', analysis.gaussian_blur, grayed)
+    lanes = timed(timings, 'detect_lanes', analysis.detect_lanes, blurred)
+    timed(timings, 'fit_lanes', analysis.fit_lanes, lanes)
+    timed(timings, 'detect_speed_signs', analysis.detect_speed_signs, blurred)
+    timed(timings, 'detect_stop_signs', analysis.detect_stop_signs, blurred)
+    timings['frame'].append(time.perf_counter_ns() - start)
+
+
+def summarize(samples):
+    milliseconds = np.array(samples, np.float64) / 1e6
+    mean = float(milliseconds.mean())
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return {'samples': len(samples),
+            'mean_ms': mean,
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'throughput_fps': 1000.0 / mean if mean > 0 else None}
+
+
+def benchmark_stages(frames, iterations):
+    analysis = create_analysis(frames[0].shape)
+    timings = {stage: [] for stage in STAGES}
+
+    # Warm up once so buffers and OpenCV internals are in place.
+    for frame in frames:
+        run_stages(analysis, frame, {stage: [] for stage in STAGES})
+
+    for _ in range(iterations):
+        for frame in frames:
+            run_stages(analysis, frame, timings)
+
+    return {stage: summarize(timings[stage]) for stage in STAGES}
+
+
+def report(source, stages):
+    for stage in STAGES:
+        stats = stages[stage]
+        logger.info(colors.blue & colors.bold |
+                    '{} {:<20} mean = {:7.2f} ms, p50 = {:7.2f} ms, '
+                    'p95 = {:7.2f} ms, p99 = {:7.2f} ms, {:8.1f} fps'
+                    .format(source, stage, stats['mean_ms'],
+                            stats['p50_ms'], stats['p95_ms'],
+                            stats['p99_ms'], stats['throughput_fps']))
+
+
+def compare(results, baseline, tolerance):
+    # A stage regresses when its p95 latency grows by more than
+    # `tolerance` (a fraction) over the baseline run of the same source.
+    regressions = []
+    for source, stages in results['sources'].items():
+        for stage, stats in stages.items():
+            try:
+                reference = baseline['sources'][source][stage]['p95_ms']
+            except KeyError:
+                continue
+            if stats['p95_ms'] > reference * (1 + tolerance):
+                regressions.append((source, stage, reference,
+                                    stats['p95_ms']))
+
+    for source, stage, reference, current in regressions:
+        logger.error(colors.red |
+                     'Regression: {} {} p95 {:.2f} ms -> {:.2f} ms'
+                     .format(source, stage, reference, current))
+    return regressions
+
+
+def preprocess(analysis, frame):
+    grayed = analysis.gray_scale(frame)
+    blurred = analysis.gaussian_blur(grayed)
+    analysis.detect_lanes(blurred)
+
+
+def bytes_per_frame(analysis, frames, iterations):
+    # Warm up once so buffers and OpenCV internals are in place.
+    for frame in frames:
+        preprocess(analysis, frame)
+
+    # NumPy reports its buffers to tracemalloc, and OpenCV allocates its
+    # output arrays through NumPy, so the traced peak per frame is the
+    # number of bytes the pipeline had to allocate for that frame.
+    tracemalloc.start()
+    allocated = 0
+    for _ in range(iterations):
+        for frame in frames:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            preprocess(analysis, frame)
+            _, peak = tracemalloc.get_traced_memory()
+            allocated += peak - before
+    tracemalloc.stop()
+    return allocated / (iterations * len(frames))
+
+
+def benchmark_allocations(frames, iterations):
+    shape = frames[0].shape
+    results = {}
+    for preallocate in (False, True):
+        analysis = create_analysis(shape, preallocate)
+        results[preallocate] = bytes_per_frame(analysis, frames, iterations)
+
+    logger.info(colors.blue & colors.bold |
+                'Preprocessing bytes allocated per frame: '
+                'default = {:.0f}, preallocated = {:.0f}'
+                .format(results[False], results[True]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks for the image analysis pipeline.')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='passes over every source')
+    parser.add_argument('--clip', action='append', default=[],
+                        help='recorded video clip to benchmark (repeatable)')
+    parser.add_argument('--clip-frames', type=int, default=300,
+                        help='maximum frames read from each clip')
+    parser.add_argument('--output',
+                        help='write the results as JSON to this file')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed fractional p95 slowdown per stage')
+    parser.add_argument('--allocations', action='store_true',
+                        help='also measure bytes allocated per frame')
+    args = parser.parse_args()
+
+    sources = {'images': load_frames(IMAGES)}
+    for path in args.clip:
+        sources[path] = load_clip(path, args.clip_frames)
+
+    results = {'opencv': cv2.__version__,
+               'iterations': args.iterations,
+               'sources': {}}
+    for source, frames in sources.items():
+        if not frames:
+            continue
+        stages = benchmark_stages(frames, args.iterations)
+        report(source, stages)
+        results['sources'][source] = stages
+
+    if args.allocations:
+        allocations = benchmark_allocations(sources['images'],
+                                            args.iterations)
+        results['allocations'] = {'default': allocations[False],
+                                  'preallocated': allocations[True]}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
+        logger.info(colors.green & colors.bold |
+                    'No stage regressed beyond {:.0%} of the baseline.'
+                    .format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
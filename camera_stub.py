@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Author: Gabriel Bustamante
+Email: gabrielbusta@gmail.com
+
+Selfdriving GoPiGo: An open source self-driving robot application.
+This app was built using the GoPiGo robotics platform for the Raspberry Pi.
+
+Copyright (C) 2017 Gabriel Bustamante
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+"""
+import time
+import cv2
+import logging
+import settings
+from plumbum import colors
+from utils import LumaFrameWriter, Server
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+IMAGES = ['images/80.jpeg',
+          'images/100.jpeg',
+          'images/120.jpeg',
+          'images/stop.jpeg']
+
+
+# Stand-in for the GoPiGo camera: serves the bundled images as a raw luma
+# stream so the client can be exercised on a workstation. Point
+# settings.ROBOT_IP at this machine and set CAMERA_VIDEO_FORMAT = 'luma'.
+def main():
+    logger.info('Camera stub waiting for a connection. Run "main.py".')
+    camera_server = Server('',
+                           settings.CAMERA_PORT,
+                           camera_stub_handle,
+                           name='CameraStubServer').start()
+
+    print(colors.green & colors.bold |
+          '\n *******************************\n'
+            ' *                             *\n'
+            ' *     PRESS ENTER TO QUIT     *\n'
+            ' *                             *\n'
+            ' *******************************\n')
+
+    input()
+    camera_server.shutdown()
+
+
+def camera_stub_handle(connection, shutdown_request, addr):
+    logger = logging.getLogger('CameraStubHandle')
+    logging.basicConfig(level=logging.DEBUG)
+    output = LumaFrameWriter(connection.makefile('wb'),
+                             settings.CAMERA_RESOLUTION)
+    frames = [cv2.resize(cv2.imread(path, cv2.IMREAD_GRAYSCALE),
+                         settings.CAMERA_RESOLUTION)
+              for path in IMAGES]
+    period = 1.0 / settings.CAMERA_FRAMERATE
+
+    logger.info(colors.blue & colors.bold |
+                'Streaming stub luma frames to {}'
+                .format(addr))
+    try:
+        deadline = time.monotonic()
+        while not shutdown_request.is_set():
+            # Hold each image for about a second, like a sign in view.
+            for frame in frames:
+                for _ in range(settings.CAMERA_FRAMERATE):
+                    output.send_luma(memoryview(frame).cast('B'))
+                    deadline += period
+                    time.sleep(max(deadline - time.monotonic(), 0))
+    except Exception as ex:
+        logger.warn(colors.yellow & colors.bold | str(ex))
+
+    logger.info(colors.blue & colors.bold |
+                'Stopped streaming stub luma frames to {}'
+                .format(addr))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,53 +19,479 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
 """
+import bisect
 import datetime
+import queue
+import signal
+import socket
+import sys
+import time
 import cv2
 import numpy as np
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from plumbum import colors
-from threading import Thread
+from threading import Condition, Lock, Thread
+from urllib.parse import parse_qs
+from recording import ReplayCapture
+from utils import LUMA_HEADER
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+Detections = namedtuple('Detections', ['lanes', 'speed_signs', 'stop_signs'])
+
+# Each lane side is a line x = slope * y + intercept in full-frame pixels,
+# or None when that side was not found. The center offset is the distance
+# of the lane center from the image center at the bottom row, normalized
+# to [-1, 1] (negative means the lane center is to the left).
+LaneModel = namedtuple('LaneModel', ['left', 'right', 'center_offset'])
+
+
+class CascadeDetector(object):
+    def __init__(self, xml, scale_factor=1.3, min_neighbors=5, roi=None,
+                 min_size=None, max_size=None, downscale=1.0):
+
+        self.classifier = cv2.CascadeClassifier(xml)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+        # The search window (x, y, w, h) and the object size bounds are
+        # given in full-frame pixels. The frame is shrunk by `downscale`
+        # before the classifier runs and detections are mapped back.
+        self.roi = roi
+        self.min_size = min_size
+        self.max_size = max_size
+        self.downscale = downscale
+        self.resize_buffer = None
+
+    def crop(self, frame):
+        if self.roi is None:
+            return frame, 0, 0
+        x, y, w, h = self.roi
+        return frame[y:y + h, x:x + w], x, y
+
+    def shrink(self, frame):
+        if self.downscale == 1.0:
+            return frame
+        height, width = frame.shape[:2]
+        size = (int(width / self.downscale), int(height / self.downscale))
+        if (self.resize_buffer is None or
+                self.resize_buffer.shape[:2] != (size[1], size[0])):
+            self.resize_buffer = np.empty((size[1], size[0]), frame.dtype)
+        return cv2.resize(frame, size, dst=self.resize_buffer,
+                          interpolation=cv2.INTER_AREA)
+
+    def scaled_size(self, size):
+        if size is None:
+            return (0, 0)
+        return (int(size[0] / self.downscale), int(size[1] / self.downscale))
+
+    def to_frame_coordinates(self, signs, x, y):
+        if len(signs) == 0:
+            return signs
+        if self.downscale != 1.0:
+            signs = np.rint(signs * self.downscale).astype(np.int32)
+        signs[:, 0] += x
+        signs[:, 1] += y
+        return signs
+
+    def detect(self, frame):
+        roi, x, y = self.crop(frame)
+        signs = self.classifier.detectMultiScale(
+            self.shrink(roi),
+            self.scale_factor,
+            self.min_neighbors,
+            minSize=self.scaled_size(self.min_size),
+            maxSize=self.scaled_size(self.max_size))
+        return self.to_frame_coordinates(signs, x, y)
+
+
+class MultiCascadeDetector(object):
+    OFFSETS = ((0, 0), (1, 0), (0, 1), (1, 1))
+
+    def __init__(self, scale_factor=1.3):
+        self.scale_factor = scale_factor
+        self.cascades = []
+        self.shape = None
+        self.levels = []
+
+    def register(self, label, xml, min_neighbors=5, min_size=None,
+                 max_size=None):
+        classifier = cv2.CascadeClassifier(xml)
+        self.cascades.append((label, classifier, min_neighbors,
+                              min_size, max_size))
+        self.shape = None
+        return self
+
+    def build_levels(self, shape):
+        # Level buffers are allocated once per frame shape and refilled in
+        # place on every frame.
+        height, width = shape[:2]
+        min_width = min(classifier.getOriginalWindowSize()[0]
+                        for _, classifier, _, _, _ in self.cascades)
+        min_height = min(classifier.getOriginalWindowSize()[1]
+                         for _, classifier, _, _, _ in self.cascades)
+        self.levels = []
+        factor = 1.0
+        while True:
+            size = (int(round(width / factor)), int(round(height / factor)))
+            if size[0] < min_width or size[1] < min_height:
+                break
+            buffer = None
+            if factor != 1.0:
+                buffer = np.empty((size[1], size[0]), np.uint8)
+            self.levels.append((factor, size, buffer))
+            factor *= self.scale_factor
+        self.shape = shape
+
+    def pyramid(self, frame):
+        if self.shape != frame.shape:
+            self.build_levels(frame.shape)
+        for factor, size, buffer in self.levels:
+            if buffer is None:
+                yield factor, frame
+            else:
+                yield factor, cv2.resize(frame, size, dst=buffer,
+                                         interpolation=cv2.INTER_LINEAR)
+
+    def detect(self, frame):
+        candidates = {label: [] for label, _, _, _, _ in self.cascades}
+        for factor, level in self.pyramid(frame):
+            height, width = level.shape[:2]
+            for label, classifier, _, min_size, max_size in self.cascades:
+                window = classifier.getOriginalWindowSize()
+                if window[0] > width or window[1] > height:
+                    continue
+                size = (window[0] * factor, window[1] * factor)
+                if min_size is not None and (size[0] < min_size[0] or
+                                             size[1] < min_size[1]):
+                    continue
+                if max_size is not None and (size[0] > max_size[0] or
+                                             size[1] > max_size[1]):
+                    continue
+                # Pinning minSize and maxSize to the training window makes
+                # the classifier scan this level only, and zero neighbors
+                # returns the raw hits so they can be grouped across levels.
+                # That scan steps 2 px, but detectMultiScale steps 1 px on
+                # levels shrunk by more than 2, so those levels are scanned
+                # from all four offsets to give min_neighbors as many hits.
+                offsets = self.OFFSETS if factor > 2 else ((0, 0),)
+                for dx, dy in offsets:
+                    hits = classifier.detectMultiScale(level[dy:, dx:], 1.1,
+                                                       0, minSize=window,
+                                                       maxSize=window)
+                    for x, y, w, h in hits:
+                        candidates[label].append(
+                            [int(round((x + dx) * factor)),
+                             int(round((y + dy) * factor)),
+                             int(round(w * factor)),
+                             int(round(h * factor))])
+
+        detections = {}
+        for label, _, min_neighbors, _, _ in self.cascades:
+            signs = candidates[label]
+            if signs:
+                signs, _ = cv2.groupRectangles(signs, min_neighbors, 0.2)
+            detections[label] = np.array(signs, np.int32).reshape(-1, 4)
+        return detections
+
+
+class SignTracker(object):
+    def __init__(self, detect, interval=5, search_margin=16,
+                 min_confidence=0.6):
+
+        # `detect` is any callable mapping a frame to (x, y, w, h) boxes.
+        # It runs every `interval` frames, or sooner when a tracked box
+        # can no longer be matched with at least `min_confidence`.
+        self.detect = detect
+        self.interval = interval
+        self.search_margin = search_margin
+        self.min_confidence = min_confidence
+        self.boxes = []
+        self.templates = []
+        self.frames_since_detection = None
+
+    def redetect(self, frame):
+        self.boxes = [tuple(box) for box in self.detect(frame)]
+        self.templates = [frame[y:y + h, x:x + w].copy()
+                          for x, y, w, h in self.boxes]
+        self.frames_since_detection = 0
+
+    def follow(self, frame, box, template):
+        x, y, w, h = box
+        frame_height, frame_width = frame.shape[:2]
+        left = max(x - self.search_margin, 0)
+        top = max(y - self.search_margin, 0)
+        right = min(x + w + self.search_margin, frame_width)
+        bottom = min(y + h + self.search_margin, frame_height)
+        if right - left < w or bottom - top < h:
+            return None
+
+        scores = cv2.matchTemplate(frame[top:bottom, left:right],
+                                   template, cv2.TM_CCOEFF_NORMED)
+        _, confidence, _, (dx, dy) = cv2.minMaxLoc(scores)
+        if confidence < self.min_confidence:
+            return None
+        return (left + dx, top + dy, w, h)
+
+    def track(self, frame):
+        boxes = []
+        for box, template in zip(self.boxes, self.templates):
+            box = self.follow(frame, box, template)
+            if box is None:
+                return False
+            boxes.append(box)
+        self.boxes = boxes
+        self.frames_since_detection += 1
+        return True
+
+    def update(self, frame):
+        if (self.frames_since_detection is None or
+                self.frames_since_detection + 1 >= self.interval or
+                not self.track(frame)):
+            self.redetect(frame)
+        return np.array(self.boxes, np.int32).reshape(-1, 4)
+
+
+class ChangeGate(object):
+    def __init__(self, threshold, max_age, size=(32, 24)):
+        # Compares a tiny thumbnail of every frame with the thumbnail of
+        # the frame the signs were last detected on. A mean absolute
+        # difference under `threshold` gray levels counts as unchanged,
+        # for at most `max_age` frames in a row.
+        self.threshold = threshold
+        self.max_age = max_age
+        self.size = size
+        self.thumbnail = np.empty((size[1], size[0]), np.uint8)
+        self.reference = np.empty((size[1], size[0]), np.uint8)
+        self.primed = False
+        self.age = 0
+
+    def unchanged(self, frame):
+        cv2.resize(frame, self.size, dst=self.thumbnail,
+                   interpolation=cv2.INTER_AREA)
+        if (self.primed and self.age < self.max_age and
+                cv2.norm(self.thumbnail, self.reference, cv2.NORM_L1) <
+                self.threshold * self.thumbnail.size):
+            self.age += 1
+            return True
+        self.thumbnail, self.reference = self.reference, self.thumbnail
+        self.primed = True
+        self.age = 0
+        return False
+
+
 class Analysis(object):
     def __init__(self, shape, stop_xml, speed_xml, lane_roi_cutoff=390,
                  stop_scale_factor=1.3, stop_min_neighbors=5,
-                 speed_scale_factor=1.3, speed_min_neighbors=5):
+                 speed_scale_factor=1.3, speed_min_neighbors=5,
+                 preallocate=False, detection_workers=0,
+                 stop_roi=None, stop_min_size=None, stop_max_size=None,
+                 stop_downscale=1.0, speed_roi=None, speed_min_size=None,
+                 speed_max_size=None, speed_downscale=1.0,
+                 sign_detection_interval=1, shared_pyramid=False,
+                 change_threshold=None, max_reuse_age=10, profiler=None):
 
-        self.height, self.width, self.channels = shape
+        self.height, self.width = shape[:2]
+        self.channels = shape[2] if len(shape) > 2 else 1
 
-        self.speed_classifier = cv2.CascadeClassifier(speed_xml)
-        self.stop_scale_factor = stop_scale_factor
-        self.stop_min_neighbors = stop_min_neighbors
+        self.stop_detector = CascadeDetector(stop_xml,
+                                             stop_scale_factor,
+                                             stop_min_neighbors,
+                                             stop_roi,
+                                             stop_min_size,
+                                             stop_max_size,
+                                             stop_downscale)
 
         logger.info(colors.blue & colors.bold |
                     'Stop sign cascade classifier: '
-                    'scale factor = {}, minimum number of neighbors = {}'
-                    .format(self.stop_scale_factor,
-                            self.stop_min_neighbors))
+                    'scale factor = {}, minimum number of neighbors = {}, '
+                    'ROI = {}, size = {} to {}, downscale = {}'
+                    .format(self.stop_detector.scale_factor,
+                            self.stop_detector.min_neighbors,
+                            stop_roi, stop_min_size, stop_max_size,
+                            stop_downscale))
 
-        self.stop_classifier = cv2.CascadeClassifier(stop_xml)
-        self.speed_scale_factor = speed_scale_factor
-        self.speed_min_neighbors = speed_min_neighbors
+        self.speed_detector = CascadeDetector(speed_xml,
+                                              speed_scale_factor,
+                                              speed_min_neighbors,
+                                              speed_roi,
+                                              speed_min_size,
+                                              speed_max_size,
+                                              speed_downscale)
 
         logger.info(colors.blue & colors.bold |
                     'Speed sign cascade classifier: '
-                    'scale factor = {}, minimum number of neighbors = {}'
-                    .format(self.speed_scale_factor,
-                            self.speed_min_neighbors))
+                    'scale factor = {}, minimum number of neighbors = {}, '
+                    'ROI = {}, size = {} to {}, downscale = {}'
+                    .format(self.speed_detector.scale_factor,
+                            self.speed_detector.min_neighbors,
+                            speed_roi, speed_min_size, speed_max_size,
+                            speed_downscale))
 
         logger.debug('HAAR cascades loaded successfully.')
 
         self.lane_roi_cutoff = lane_roi_cutoff
 
+        # In pipeline mode every preprocessing stage writes into a buffer
+        # allocated once here, so the main loop does not allocate a new
+        # frame-sized array per stage. Results returned by gray_scale,
+        # gaussian_blur and detect_lanes' edge map are overwritten on the
+        # next call; copy them if they must outlive the current frame.
+        self.preallocate = preallocate
+        self.gray_buffer = None
+        self.blur_buffer = None
+        self.canny_buffer = None
+
+        if self.preallocate:
+            self.gray_buffer = np.empty((self.height, self.width), np.uint8)
+            self.blur_buffer = np.empty((self.height, self.width), np.uint8)
+            self.canny_buffer = np.empty((self.height - self.lane_roi_cutoff,
+                                          self.width), np.uint8)
+            logger.debug('Preallocated analysis pipeline buffers.')
+
+        # The detectors only read the blurred frame and OpenCV releases the
+        # GIL while they run, so they can be evaluated side by side.
+        self.detection_pool = None
+        if detection_workers > 0:
+            self.detection_pool = ThreadPoolExecutor(
+                max_workers=detection_workers,
+                thread_name_prefix='AnalysisWorker')
+            logger.debug('Started {} detection workers.'
+                         .format(detection_workers))
+
+        # A shared pyramid evaluates both cascades on one set of resized
+        # frames. It replaces the per-cascade ROI, downscale and tracking.
+        self.sign_detector = None
+        if shared_pyramid:
+            self.sign_detector = MultiCascadeDetector(stop_scale_factor)
+            self.sign_detector.register('stop', stop_xml,
+                                        stop_min_neighbors,
+                                        stop_min_size, stop_max_size)
+            self.sign_detector.register('speed', speed_xml,
+                                        speed_min_neighbors,
+                                        speed_min_size, speed_max_size)
+            logger.debug('Sign cascades share one image pyramid.')
+
+        # With an interval above one the cascades only run every few
+        # frames and the signs are followed by template matching between.
+        self.speed_tracker = None
+        self.stop_tracker = None
+        if sign_detection_interval > 1:
+            self.speed_tracker = SignTracker(self.speed_detector.detect,
+                                             sign_detection_interval)
+            self.stop_tracker = SignTracker(self.stop_detector.detect,
+                                            sign_detection_interval)
+            logger.debug('Sign detection runs every {} frames.'
+                         .format(sign_detection_interval))
+
+        # Frames that barely differ from the one the signs were last
+        # detected on reuse those detections; the lanes are still fitted.
+        self.change_gate = None
+        self.sign_cache = None
+        if change_threshold is not None:
+            self.change_gate = ChangeGate(change_threshold, max_reuse_age)
+            logger.debug('Sign detections are reused for up to {} frames '
+                         'that changed less than {} gray levels.'
+                         .format(max_reuse_age, change_threshold))
+
+        # Optional StageProfiler timing each detector, including the ones
+        # running on the worker threads.
+        self.profiler = profiler
+
+
+    def timed(self, stage, detector, frame):
+        if self.profiler is None:
+            return detector(frame)
+        start = time.perf_counter_ns()
+        result = detector(frame)
+        self.profiler.record(stage, time.perf_counter_ns() - start)
+        return result
+
+    def detect(self, frame):
+        if (self.change_gate is not None and
+                self.timed('change_gate', self.change_gate.unchanged,
+                           frame) and
+                self.sign_cache is not None):
+            lanes = self.timed('detect_lanes', self.detect_lanes, frame)
+            return self.sign_cache._replace(lanes=lanes)
+
+        detections = self.run_detectors(frame)
+        if self.change_gate is not None:
+            self.sign_cache = detections
+        return detections
+
+    def run_detectors(self, frame):
+        if self.sign_detector is not None:
+            return self.detect_with_shared_pyramid(frame)
+
+        if self.detection_pool is None:
+            return Detections(
+                self.timed('detect_lanes', self.detect_lanes, frame),
+                self.timed('detect_speed_signs', self.detect_speed_signs,
+                           frame),
+                self.timed('detect_stop_signs', self.detect_stop_signs,
+                           frame))
+
+        lanes = self.detection_pool.submit(self.timed, 'detect_lanes',
+                                           self.detect_lanes, frame)
+        speed_signs = self.detection_pool.submit(self.timed,
+                                                 'detect_speed_signs',
+                                                 self.detect_speed_signs,
+                                                 frame)
+        stop_signs = self.detection_pool.submit(self.timed,
+                                                'detect_stop_signs',
+                                                self.detect_stop_signs,
+                                                frame)
+        return Detections(lanes.result(),
+                          speed_signs.result(),
+                          stop_signs.result())
+
+    def detect_with_shared_pyramid(self, frame):
+        if self.detection_pool is None:
+            lanes = self.timed('detect_lanes', self.detect_lanes, frame)
+            signs = self.timed('detect_signs', self.sign_detector.detect,
+                               frame)
+            return Detections(lanes, signs['speed'], signs['stop'])
+
+        lanes = self.detection_pool.submit(self.timed, 'detect_lanes',
+                                           self.detect_lanes, frame)
+        signs = self.timed('detect_signs', self.sign_detector.detect, frame)
+        return Detections(lanes.result(), signs['speed'], signs['stop'])
+
+    def set_quality(self, scale_factor, downscale, detection_interval):
+        # Called between frames, never while a detection is running.
+        for detector in (self.stop_detector, self.speed_detector):
+            detector.scale_factor = scale_factor
+            detector.downscale = downscale
+
+        if (self.sign_detector is not None and
+                self.sign_detector.scale_factor != scale_factor):
+            self.sign_detector.scale_factor = scale_factor
+            self.sign_detector.shape = None
+
+        if self.speed_tracker is None and detection_interval > 1:
+            self.speed_tracker = SignTracker(self.speed_detector.detect,
+                                             detection_interval)
+            self.stop_tracker = SignTracker(self.stop_detector.detect,
+                                            detection_interval)
+        elif self.speed_tracker is not None:
+            self.speed_tracker.interval = detection_interval
+            self.stop_tracker.interval = detection_interval
+
+    def release(self):
+        if self.detection_pool is not None:
+            self.detection_pool.shutdown(wait=True)
+            self.detection_pool = None
 
     def detect_lanes(self, frame):
+        # Slicing whole rows yields a contiguous view, not a copy.
         roi = frame[self.lane_roi_cutoff:self.height, 0:self.width]
-        roi_canny = cv2.Canny(roi, 90, 200)
+        roi_canny = cv2.Canny(roi, 90, 200, edges=self.canny_buffer)
         lanes = cv2.HoughLinesP(roi_canny,
                                 1,
                                 np.pi / 180,
@@ -75,31 +501,104 @@ class Analysis(object):
                                 maxLineGap=20)
         return lanes
 
+    def fit_lanes(self, lanes, min_slope=0.3, max_deviation=2.5):
+        if lanes is None or len(lanes) == 0:
+            return LaneModel(None, None, None)
+
+        segments = lanes.reshape(-1, 4).astype(np.float32)
+        x1, y1, x2, y2 = segments.T
+        y1 = y1 + self.lane_roi_cutoff
+        y2 = y2 + self.lane_roi_cutoff
+        dx = x2 - x1
+        dy = y2 - y1
+
+        # Nearly horizontal segments are floor texture, not lane markings.
+        steep = (dy != 0) & (np.abs(dy) >= min_slope * np.abs(dx))
+        # The image y axis points down, so left markings lean the other way.
+        # Vertical segments lean neither way and go with their half of
+        # the frame.
+        leaning_left = np.where(dx == 0, x1 < self.width / 2.0, dx * dy < 0)
+        left = steep & leaning_left
+        right = steep & ~leaning_left
+
+        slopes = np.zeros_like(dx)
+        slopes[steep] = dx[steep] / dy[steep]
+        intercepts = x1 - slopes * y1
+        lengths = np.hypot(dx, dy)
+
+        left_line = self.fit_lane_side(left, slopes, intercepts, lengths,
+                                       x1, y1, x2, y2, max_deviation)
+        right_line = self.fit_lane_side(right, slopes, intercepts, lengths,
+                                        x1, y1, x2, y2, max_deviation)
+
+        center_offset = None
+        if left_line is not None and right_line is not None:
+            bottom = self.height - 1
+            left_x = left_line[0] * bottom + left_line[1]
+            right_x = right_line[0] * bottom + right_line[1]
+            half_width = self.width / 2.0
+            center_offset = ((left_x + right_x) / 2.0 - half_width) / half_width
+            center_offset = float(np.clip(center_offset, -1.0, 1.0))
+
+        return LaneModel(left_line, right_line, center_offset)
+
+    def fit_lane_side(self, side, slopes, intercepts, lengths,
+                      x1, y1, x2, y2, max_deviation):
+        if not side.any():
+            return None
+
+        # Reject segments whose slope or position at the bottom of the
+        # frame is far from the side's median, in units of the median
+        # absolute deviation.
+        bottom_x = slopes[side] * (self.height - 1) + intercepts[side]
+        inliers = np.ones(bottom_x.shape, bool)
+        for values in (slopes[side], bottom_x):
+            median = np.median(values)
+            deviation = np.abs(values - median)
+            spread = np.median(deviation)
+            if spread > 0:
+                inliers &= deviation <= max_deviation * 1.4826 * spread
+
+        indices = np.flatnonzero(side)[inliers]
+        ys = np.concatenate((y1[indices], y2[indices]))
+        if np.ptp(ys) == 0:
+            return None
+        xs = np.concatenate((x1[indices], x2[indices]))
+        weights = np.concatenate((lengths[indices], lengths[indices]))
+        slope, intercept = np.polyfit(ys, xs, 1, w=weights)
+        return float(slope), float(intercept)
+
     def detect_speed_signs(self, frame):
-        return self.speed_classifier.detectMultiScale(frame,
-                                                      self.speed_scale_factor,
-                                                      self.speed_min_neighbors)
+        if self.speed_tracker is not None:
+            return self.speed_tracker.update(frame)
+        return self.speed_detector.detect(frame)
 
     def detect_stop_signs(self, frame):
-        return self.stop_classifier.detectMultiScale(frame,
-                                                     self.stop_scale_factor,
-                                                     self.stop_min_neighbors)
+        if self.stop_tracker is not None:
+            return self.stop_tracker.update(frame)
+        return self.stop_detector.detect(frame)
 
 
     def gaussian_blur(self, frame, kernel_size=(5, 5), sigma=0):
-        return cv2.GaussianBlur(frame, kernel_size, sigma)
+        return cv2.GaussianBlur(frame, kernel_size, sigma,
+                                dst=self.blur_buffer)
 
     def gray_scale(self, frame):
-        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # Luma streams already deliver single channel frames.
+        if frame.ndim == 2:
+            return frame
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray_buffer)
 
 
 class Display(object):
     def __init__(self, line_thickness=3, font=cv2.FONT_HERSHEY_SIMPLEX,
-                 font_thickness=1, font_scale=1, lane_roi_offset=390):
+                 font_thickness=1, font_scale=1, lane_roi_offset=390,
+                 mode='window', render_every=1):
 
         self.BLUE = (255, 0, 0)
         self.GREEN = (0, 255, 0)
         self.RED = (0, 0, 255)
+        self.YELLOW = (0, 255, 255)
 
         self.line_thickness = line_thickness
         self.font = font
@@ -107,27 +606,164 @@ class Display(object):
         self.font_scale = font_scale
         self.lane_roi_offset = lane_roi_offset
 
+        # 'window' draws and shows on the caller's thread, 'threaded' hands
+        # frames to a display thread that only ever shows the newest one,
+        # and 'headless' shows nothing and reads keys from stdin (or takes
+        # Ctrl-C as "q"). Only every `render_every`th frame is rendered.
+        self.mode = mode
+        self.render_every = render_every
+        self.num_frames = 0
+        self.shown = False
+        self.keys = queue.Queue()
+
+        self.display_ready = Condition()
+        self.buffers = None
+        self.annotations = None
+        self.has_pending = False
+        self.dropped_frames = 0
+        self.shutdown_request = False
+        self.interrupted = False
+
+    def interrupt(self, *args):
+        # The first Ctrl-C asks the main loop to quit, also while it is
+        # waiting for the camera; a second one raises KeyboardInterrupt.
+        if self.interrupted:
+            raise KeyboardInterrupt
+        self.interrupted = True
+        self.keys.put('q')
+
     def create_windows(self):
-        cv2.namedWindow('GOPIGO')
+        if self.mode == 'threaded':
+            self.thread = Thread(target=self.display_loop,
+                                 name='DisplayThread')
+            self.thread.start()
+        elif self.mode == 'headless':
+            signal.signal(signal.SIGINT, self.interrupt)
+            Thread(target=self.read_stdin, name='KeyListener',
+                   daemon=True).start()
+        else:
+            cv2.namedWindow('GOPIGO')
 
     def destroy_windows(self):
-        cv2.destroyAllWindows()
+        if self.mode == 'threaded':
+            with self.display_ready:
+                self.shutdown_request = True
+                self.display_ready.notify_all()
+            self.thread.join()
+            logger.debug('Display thread skipped {} stale frames.'
+                         .format(self.dropped_frames))
+        elif self.mode == 'window':
+            cv2.destroyAllWindows()
 
     def show(self, frame):
         cv2.imshow('GOPIGO', frame)
 
+    def render(self, frame, detections, lane_model, distance=None):
+        self.num_frames += 1
+        if self.mode == 'headless' or self.num_frames % self.render_every:
+            return
+
+        if self.mode == 'threaded':
+            self.post(frame, detections, lane_model, distance)
+        else:
+            self.annotate(frame, detections, lane_model, distance)
+            self.show(frame)
+            self.shown = True
+
+    def annotate(self, frame, detections, lane_model, distance=None):
+        self.draw_lanes(frame, detections.lanes)
+        self.draw_lane_model(frame, lane_model)
+        self.draw_speed_signs(frame, detections.speed_signs)
+        self.draw_stop_signs(frame, detections.stop_signs)
+        if distance is not None:
+            self.draw_distance(frame, distance)
+
+    def post(self, frame, detections, lane_model, distance=None):
+        # Triple buffering: the caller copies into the free buffer and
+        # swaps it with the pending one, the display thread swaps the
+        # pending buffer with the one it shows. A pending frame that was
+        # never shown is simply overwritten.
+        if self.buffers is None or self.buffers[0].shape != frame.shape:
+            with self.display_ready:
+                self.buffers = [np.empty_like(frame) for _ in range(3)]
+                self.has_pending = False
+        np.copyto(self.buffers[0], frame)
+        with self.display_ready:
+            self.buffers[0], self.buffers[1] = self.buffers[1], self.buffers[0]
+            self.annotations = (detections, lane_model, distance)
+            if self.has_pending:
+                self.dropped_frames += 1
+            self.has_pending = True
+            self.display_ready.notify_all()
+
+    def display_loop(self):
+        # HighGUI calls all stay on this thread.
+        cv2.namedWindow('GOPIGO')
+        while True:
+            with self.display_ready:
+                self.display_ready.wait_for(
+                    lambda: self.has_pending or self.shutdown_request,
+                    timeout=0.03)
+                if self.shutdown_request:
+                    break
+                fresh = self.has_pending
+                if fresh:
+                    self.buffers[1], self.buffers[2] = (self.buffers[2],
+                                                        self.buffers[1])
+                    frame = self.buffers[2]
+                    detections, lane_model, distance = self.annotations
+                    self.has_pending = False
+
+            if fresh:
+                self.annotate(frame, detections, lane_model, distance)
+                self.show(frame)
+            key = cv2.waitKey(1) & 0xFF
+            if key != 0xFF:
+                self.keys.put(chr(key))
+        cv2.destroyAllWindows()
+
+    def read_stdin(self):
+        for line in sys.stdin:
+            if line.strip():
+                self.keys.put(line.strip()[0])
+
     def get_key_pressed(self):
-        return chr(cv2.waitKey(1))
+        if self.mode == 'window':
+            # Poll HighGUI only after a frame was actually shown.
+            if not self.shown:
+                return ''
+            self.shown = False
+            return chr(cv2.waitKey(1) & 0xFF)
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return ''
 
     def draw_lanes(self, frame, lanes):
         if lanes is not None:
-            for lane in lanes:
-                for x1, y1, x2, y2 in lane:
-                    cv2.line(frame,
-                             (x1, y1 + self.lane_roi_offset),
-                             (x2, y2 + self.lane_roi_offset),
-                             self.BLUE,
-                             self.line_thickness)
+            segments = lanes.reshape(-1, 2, 2).astype(np.int32)
+            segments[:, :, 1] += self.lane_roi_offset
+            cv2.polylines(frame, segments, False, self.BLUE,
+                          self.line_thickness)
+
+    def draw_lane_model(self, frame, lane_model):
+        height = frame.shape[0]
+        for line in (lane_model.left, lane_model.right):
+            if line is None:
+                continue
+            slope, intercept = line
+            top_x = slope * self.lane_roi_offset + intercept
+            bottom_x = slope * (height - 1) + intercept
+            cv2.line(frame,
+                     (int(top_x), self.lane_roi_offset),
+                     (int(bottom_x), height - 1),
+                     self.YELLOW,
+                     self.line_thickness)
+
+    def draw_distance(self, frame, distance):
+        cv2.putText(frame, 'Obstacle: {} cm'.format(distance), (10, 30),
+                    self.font, self.font_scale, self.YELLOW,
+                    self.font_thickness, cv2.LINE_AA)
 
     def draw_speed_signs(self, frame, signs):
         for x, y, w, h in signs:
@@ -144,18 +780,143 @@ class Display(object):
                         self.RED, self.font_thickness, cv2.LINE_AA)
 
 
+class LumaCapture(object):
+    # Reads the raw luma stream sent by servers.camera_handle and exposes
+    # it through the subset of the cv2.VideoCapture interface VideoStream
+    # uses. Frames are received straight into the caller's buffer.
+    def __init__(self, ip, port):
+        self.socket = socket.create_connection((ip, port))
+        self.header = bytearray(LUMA_HEADER.size)
+
+    def receive_into(self, view):
+        while len(view):
+            received = self.socket.recv_into(view)
+            if not received:
+                return False
+            view = view[received:]
+        return True
+
+    def read(self, image=None):
+        try:
+            if not self.receive_into(memoryview(self.header)):
+                return False, None
+            width, height, length = LUMA_HEADER.unpack(self.header)
+            if length != width * height:
+                logger.error(colors.red |
+                             'Malformed luma frame header: {}x{}, {} bytes'
+                             .format(width, height, length))
+                return False, None
+            if image is None or image.shape != (height, width):
+                image = np.empty((height, width), np.uint8)
+            if not self.receive_into(memoryview(image).cast('B')):
+                return False, None
+        except OSError as ex:
+            logger.warn(colors.yellow & colors.bold |
+                        'LumaCapture {}'.format(ex))
+            return False, None
+        return True, image
+
+    def release(self):
+        self.socket.close()
+
+
+def open_capture(url):
+    # 'luma://host:port' selects the raw luma stream and
+    # 'replay://path?mode=fast&start=N' plays a recording back. Anything
+    # else is handed to OpenCV.
+    if url.startswith('luma://'):
+        ip, port = url[len('luma://'):].rsplit(':', 1)
+        return LumaCapture(ip, int(port))
+    if url.startswith('replay://'):
+        path, _, query = url[len('replay://'):].partition('?')
+        options = parse_qs(query)
+        return ReplayCapture(path,
+                             options.get('mode', ['realtime'])[0],
+                             int(options.get('start', [0])[0]))
+    return cv2.VideoCapture(url)
+
+
+class FrameRing(object):
+    def __init__(self, frame, depth):
+        # Fixed set of frame buffers shaped like `frame`. A slot that is
+        # borrowed by a consumer is never overwritten until given back.
+        if depth < 2:
+            raise ValueError('A frame ring needs at least two slots.')
+        self.slots = [np.empty_like(frame) for _ in range(depth)]
+        self.sequences = [0] * depth
+        self.timestamps = [None] * depth
+        self.borrowed = [0] * depth
+        self.scratch = np.empty_like(frame)
+        self.latest = None
+
+    def writable(self):
+        # Oldest slot that nobody holds, or None if every slot is busy.
+        # The slot is unpublished right away so history() cannot lend it
+        # out while the next frame is decoded into it.
+        free = [slot for slot in range(len(self.slots))
+                if self.borrowed[slot] == 0 and slot != self.latest]
+        if not free:
+            return None
+        slot = min(free, key=lambda slot: self.sequences[slot])
+        self.sequences[slot] = 0
+        return slot
+
+    def publish(self, slot, frame, sequence, timestamp):
+        self.slots[slot] = frame
+        self.sequences[slot] = sequence
+        self.timestamps[slot] = timestamp
+        self.latest = slot
+
+    def history(self, count):
+        # Most recently published slots first.
+        published = [slot for slot in range(len(self.slots))
+                     if self.sequences[slot] > 0]
+        published.sort(key=lambda slot: self.sequences[slot], reverse=True)
+        return published[:count]
+
+
 class VideoStream(object):
-    def __init__(self, url):
-        self.stream = cv2.VideoCapture(url)
-        self.streaming, self.frame = self.stream.read()
+    def __init__(self, url, ring_depth=4, lossless=False):
+        try:
+            self.stream = open_capture(url)
+            self.streaming, frame = self.stream.read()
+        except OSError:
+            self.streaming = False
 
         if not self.streaming:
             logger.error(colors.red |
                         'VideoStream not started. Run "servers.py" on the GoPiGo!')
             exit(1)
 
+        # Frames are decoded in place into a ring of preallocated buffers
+        # and handed out without copying. read() and read_next() return
+        # the ring buffer itself, which stays valid for ring_depth - 1
+        # newer frames; use borrow_next() to hold a frame for longer.
+        self.ring = FrameRing(frame, ring_depth)
+        self.ring.publish(0, frame, 1, time.monotonic())
+
+        # Every captured frame gets a sequence number and a monotonic
+        # capture time. Consumers that wait with read_next() are woken
+        # when a newer frame is published.
+        self.frame_available = Condition()
+        self.sequence = 1
+        self.read_sequence = 0
+        self.read_timestamp = None
+        self.dropped_frames = 0
+        self.duplicated_frames = 0
+        self.overrun_frames = 0
+
+        # A lossless stream waits for the consumer to take each frame
+        # before capturing the next one, e.g. to replay a recording as
+        # fast as the analysis can go without skipping frames.
+        self.lossless = lossless
+
         self.shutdown_request = False
 
+    @property
+    def frame(self):
+        return self.ring.slots[self.ring.latest]
+
     def start(self):
         self.thread = Thread(target=self.update)
         self.thread.start()
@@ -163,15 +924,269 @@ class VideoStream(object):
 
     def update(self):
         while not self.shutdown_request:
-            self.streaming, self.frame = self.stream.read()
+            with self.frame_available:
+                if self.lossless:
+                    self.frame_available.wait_for(
+                        lambda: (self.read_sequence >= self.sequence or
+                                 self.shutdown_request))
+                # Claimed under the lock, see FrameRing.writable().
+                slot = self.ring.writable()
+
+            if slot is None:
+                # Every slot is held by a consumer: keep the decoder
+                # draining the socket but throw the frame away.
+                self.streaming, _ = self.stream.read(self.ring.scratch)
+                self.overrun_frames += 1
+                continue
+
+            streaming, frame = self.stream.read(self.ring.slots[slot])
+            with self.frame_available:
+                self.streaming = streaming
+                if streaming:
+                    self.sequence += 1
+                    self.ring.publish(slot, frame, self.sequence,
+                                      time.monotonic())
+                self.frame_available.notify_all()
+
+    def take(self):
+        # Must be called with the condition held.
+        if self.sequence == self.read_sequence:
+            self.duplicated_frames += 1
+        elif self.sequence > self.read_sequence + 1:
+            self.dropped_frames += self.sequence - self.read_sequence - 1
+        self.read_sequence = self.sequence
+        self.read_timestamp = self.ring.timestamps[self.ring.latest]
+        if self.lossless:
+            self.frame_available.notify_all()
+        return self.ring.latest
+
+    def wait_for_next(self, timeout):
+        # Must be called with the condition held.
+        return self.frame_available.wait_for(
+            lambda: (self.sequence > self.read_sequence or
+                     not self.streaming or self.shutdown_request),
+            timeout)
 
     def read(self):
-        return self.streaming, self.frame
+        with self.frame_available:
+            return self.streaming, self.ring.slots[self.take()]
+
+    def read_next(self, timeout=None):
+        # Blocks until a frame newer than the last one read is available.
+        # Returns a None frame if the timeout expires first.
+        with self.frame_available:
+            if not self.wait_for_next(timeout):
+                return self.streaming, None
+            return self.streaming, self.ring.slots[self.take()]
+
+    def borrow_next(self, timeout=None):
+        # Like read_next(), but the slot is not reused until give_back().
+        with self.frame_available:
+            if not self.wait_for_next(timeout):
+                return self.streaming, None, None
+            slot = self.take()
+            self.ring.borrowed[slot] += 1
+            return self.streaming, slot, self.ring.slots[slot]
+
+    def borrow_history(self, count):
+        # The `count` most recent frames, newest first, as (slot, frame).
+        with self.frame_available:
+            slots = self.ring.history(count)
+            for slot in slots:
+                self.ring.borrowed[slot] += 1
+            return [(slot, self.ring.slots[slot]) for slot in slots]
+
+    def give_back(self, slot):
+        with self.frame_available:
+            self.ring.borrowed[slot] -= 1
+
+    def seek(self, frame_number):
+        # Only replayed streams (see recording.ReplayCapture) can seek.
+        self.stream.seek(frame_number)
 
     def release(self):
-        self.shutdown_request = True
+        with self.frame_available:
+            self.shutdown_request = True
+            self.frame_available.notify_all()
         self.thread.join()
         self.stream.release()
+        logger.info(colors.blue & colors.bold |
+                    'VideoStream: {} frames captured, {} dropped, '
+                    '{} duplicated, {} overran the frame ring'
+                    .format(self.sequence,
+                            self.dropped_frames,
+                            self.duplicated_frames,
+                            self.overrun_frames))
+
+
+class LatencyHistogram(object):
+    # Geometric buckets from 10 us to about 4 s, 25% apart. Recording a
+    # sample is a bisect and an increment; percentiles are read back as
+    # the upper bound of the bucket they fall in.
+    BOUNDS = [int(10000 * 1.25 ** i) for i in range(58)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def record(self, nanoseconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, nanoseconds)] += 1
+        self.total += 1
+
+    def percentile(self, fraction):
+        if self.total == 0:
+            return None
+        rank = fraction * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if bucket == len(self.BOUNDS):
+                    return float('inf')
+                return self.BOUNDS[bucket]
+        return self.BOUNDS[-1]
+
+    def reset(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+
+class StageProfiler(object):
+    def __init__(self, report_interval=10.0):
+        # Each named stage keeps a histogram of the current reporting
+        # window and one of the whole run. record() may be called from
+        # the analysis worker threads, hence the lock.
+        self.report_interval_ns = int(report_interval * 1e9)
+        self.window = {}
+        self.overall = {}
+        self.lock = Lock()
+        self.num_frames = 0
+        self.start_time = None
+        self.end_time = None
+        self.frame_start = None
+        self.last_mark = None
+        self.last_report = None
+
+    def start(self):
+        self.start_time = time.perf_counter_ns()
+        self.last_report = self.start_time
+        return self
+
+    def record(self, stage, nanoseconds):
+        with self.lock:
+            if stage not in self.overall:
+                self.window[stage] = LatencyHistogram()
+                self.overall[stage] = LatencyHistogram()
+            self.window[stage].record(nanoseconds)
+            self.overall[stage].record(nanoseconds)
+
+    def begin_frame(self):
+        self.frame_start = self.last_mark = time.perf_counter_ns()
+
+    def mark(self, stage):
+        # Time since the previous mark (or the start of the frame).
+        now = time.perf_counter_ns()
+        self.record(stage, now - self.last_mark)
+        self.last_mark = now
+
+    def end_frame(self):
+        now = time.perf_counter_ns()
+        self.record('frame', now - self.frame_start)
+        self.num_frames += 1
+        if now - self.last_report >= self.report_interval_ns:
+            self.report(self.window, 'last {:.0f} s'
+                        .format(self.report_interval_ns / 1e9))
+            with self.lock:
+                for histogram in self.window.values():
+                    histogram.reset()
+            self.last_report = now
+
+    def report(self, histograms, title):
+        with self.lock:
+            lines = ['{:<20} p50 = {:8.2f} ms, p99 = {:8.2f} ms ({})'
+                     .format(stage,
+                             histogram.percentile(0.5) / 1e6,
+                             histogram.percentile(0.99) / 1e6,
+                             histogram.total)
+                     for stage, histogram in histograms.items()
+                     if histogram.total]
+        logger.info(colors.blue & colors.bold |
+                    'Stage latency, {}:\n  {}'
+                    .format(title, '\n  '.join(lines)))
+
+    def stop(self):
+        self.end_time = time.perf_counter_ns()
+        self.report(self.overall, 'whole run')
+
+    def elapsed(self):
+        return (self.end_time - self.start_time) / 1e9
+
+    def fps(self):
+        return self.num_frames / self.elapsed()
+
+
+class QualityController(object):
+    def __init__(self, analysis, budget, ladder, window=30, headroom=0.7,
+                 patience=3):
+        # Holds the per-frame processing time under `budget` seconds by
+        # walking `ladder`, a list of (scale factor, downscale, detection
+        # interval) settings from best quality to cheapest. After every
+        # `window` frames it steps down a level if the 90th percentile is
+        # over budget, and steps back up only after `patience` windows in
+        # a row stayed under `headroom` of the budget. A step up that is
+        # undone by the very next window doubles the patience.
+        self.analysis = analysis
+        self.budget_ns = int(budget * 1e9)
+        self.ladder = ladder
+        self.window = window
+        self.headroom = headroom
+        self.initial_patience = patience
+        self.patience = patience
+        self.samples = []
+        self.calm_windows = 0
+        self.probing = False
+        self.frame_start = None
+        self.level = 0
+        self.apply(0)
+
+    def apply(self, level):
+        self.level = level
+        self.analysis.set_quality(*self.ladder[level])
+        logger.info(colors.blue & colors.bold |
+                    'Quality level {}: scale factor = {}, downscale = {}, '
+                    'detection interval = {}'
+                    .format(level, *self.ladder[level]))
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter_ns()
+
+    def end_frame(self):
+        self.samples.append(time.perf_counter_ns() - self.frame_start)
+        if len(self.samples) < self.window:
+            return
+        self.samples.sort()
+        latency = self.samples[int(0.9 * (len(self.samples) - 1))]
+        self.samples = []
+
+        if latency > self.budget_ns:
+            if self.probing:
+                self.patience *= 2
+            self.probing = False
+            self.calm_windows = 0
+            if self.level + 1 < len(self.ladder):
+                self.apply(self.level + 1)
+        elif latency < self.headroom * self.budget_ns:
+            if self.probing:
+                self.patience = self.initial_patience
+            self.probing = False
+            self.calm_windows += 1
+            if self.calm_windows >= self.patience and self.level > 0:
+                self.calm_windows = 0
+                self.probing = True
+                self.apply(self.level - 1)
+        else:
+            self.probing = False
+            self.calm_windows = 0
 
 
 class FPSTimer(object):
@@ -40,26 +40,51 @@ along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
 import sys
 import time
 import math
+import heapq
 import struct
+import functools
+import itertools
+import threading
 import subprocess
+from concurrent.futures import Future
 
 WHEEL_RAD=3.25
 WHEEL_CIRC=2*math.pi*WHEEL_RAD
 PPR = 18 # encoder Pulses Per Revolution
 
-if sys.platform == 'uwp':
-	import winrt_smbus as smbus
-	bus = smbus.SMBus(1)
-else:
+# The bus is opened and the board version detected on first use, so
+# importing this module touches no hardware.
+bus=None
+version=None
+
+# Open the platform I2C bus
+def open_bus():
+	if sys.platform == 'uwp':
+		import winrt_smbus as smbus
+		return smbus.SMBus(1)
+
 	import RPi.GPIO as GPIO
 	import smbus
 
 	# for RPI version 1, use "bus = smbus.SMBus(0)"
 	rev = GPIO.RPI_REVISION
 	if rev == 2 or rev == 3:
-		bus = smbus.SMBus(1)
+		return smbus.SMBus(1)
 	else:
-		bus = smbus.SMBus(0)
+		return smbus.SMBus(0)
+
+# Use another bus backend, call before the first command. A backend needs
+# the smbus methods used here: write_i2c_block_data, write_byte, read_byte
+# and read_i2c_block_data, see gopigo_sim.SimulatedGoPiGo.
+def set_bus(backend):
+	global bus
+	bus=backend
+
+def get_bus():
+	global bus
+	if bus is None:
+		bus=open_bus()
+	return bus
 
 # This is the address for the GoPiGo
 address = 0x08
@@ -136,40 +161,255 @@ def en_slow_i2c():
 	subprocess.call('sudo modprobe i2c_bcm2708 baudrate=70000',shell=True)
 '''
 
-#Write I2C block
-def write_i2c_block(address,block):
+# All bus access is serialized through one worker thread. Instead of
+# sleeping after every operation, the worker waits out each operation's
+# minimum gap only when the next operation is ready to go. stop() jumps
+# the queue and drops queued motion commands, a queued motion or
+# speed write is replaced by a newer one of the same kind, and a speed
+# write identical to the previous bus operation is skipped.
+# Sensor reads are exchanges: the command is written, and the answer is
+# read once the firmware's settle time has passed. The firmware keeps a
+# single answer buffer, so only one exchange is in flight at a time, but
+# writes keep flowing while it settles and the caller only waits if it
+# asks for the result. Identical reads queued together share one exchange.
+class I2CScheduler(object):
+	STOP=0
+	WRITE=1
+	TRANSACTION=2
+
+	def __init__(self,gap=.005):
+		self.gap=gap
+		self.queue=[]
+		self.pending={}
+		self.order=itertools.count()
+		self.condition=threading.Condition()
+		self.ready_at=0
+		self.last_block=None
+		self.settling=None
+		self.worker=None
+
+	def on_worker(self):
+		return threading.current_thread() is self.worker
+
+	def job(self,run,priority=TRANSACTION,gap=None,key=None,block=None,dedupe=False,settle=None,finish=None):
+		job=Future()
+		job.run=run
+		job.priority=priority
+		job.gap=self.gap if gap is None else gap
+		job.key=key
+		job.block=block
+		job.dedupe=dedupe
+		job.settle=settle
+		job.finish=finish
+		return job
+
+	def submit(self,run,**kwargs):
+		job=self.job(run,**kwargs)
+		with self.condition:
+			if self.worker is None:
+				get_bus()
+				self.worker=threading.Thread(target=self.work,name='I2CScheduler')
+				self.worker.daemon=True
+				self.worker.start()
+			if job.priority==self.STOP:
+				self.drop_queued_motion()
+			if job.key in self.pending:
+				if job.finish is not None:
+					return self.pending[job.key]
+				self.supersede(self.pending[job.key],job)
+			if job.key is not None:
+				self.pending[job.key]=job
+			heapq.heappush(self.queue,(job.priority,next(self.order),job))
+			self.condition.notify()
+		return job
+
+	def exchange(self,block,settle,finish):
+		# Returns a Future, wrap it with asyncio.wrap_future to await it
+		# Only reads that also decode the answer the same way can share
+		kwargs=dict(key=('read',tuple(block),finish),block=tuple(block),settle=settle,finish=finish)
+		if self.on_worker():
+			job=self.job(lambda: _write_i2c_block(address,block),**kwargs)
+			self.execute(job,inline=True)
+			return job
+		return self.submit(lambda: _write_i2c_block(address,block),**kwargs)
+
+	def call(self,run,**kwargs):
+		# Operations issued from inside a transaction run right away, they
+		# already own the bus.
+		if self.on_worker():
+			job=self.job(run,**kwargs)
+			self.execute(job,inline=True)
+			return job.result()
+		return self.submit(run,**kwargs).result()
+
+	def supersede(self,old,new):
+		# The caller of the replaced write gets the result of the new one.
+		old.run=None
+		def forward(done):
+			if done.exception() is not None:
+				old.set_exception(done.exception())
+			else:
+				old.set_result(done.result())
+		new.add_done_callback(forward)
+
+	def drop_queued_motion(self):
+		# Speed writes are kept, the speed outlasts the stop
+		for _,_,job in self.queue:
+			if job.key=='motion' and job.run is not None:
+				job.run=None
+				job.set_result(0)
+				del self.pending[job.key]
+
+	def next_job(self):
+		while True:
+			now=time.monotonic()
+			if self.settling is not None and now>=self.settling.deadline:
+				job,self.settling=self.settling,None
+				return job
+			if self.queue and (self.settling is None or self.queue[0][0]<self.TRANSACTION):
+				_,_,job=heapq.heappop(self.queue)
+				if job.key is not None and self.pending.get(job.key) is job:
+					del self.pending[job.key]
+				return job
+			self.condition.wait(None if self.settling is None else self.settling.deadline-now)
+
+	def work(self):
+		while True:
+			with self.condition:
+				job=self.next_job()
+			if job.run is not None:
+				self.execute(job)
+
+	def execute(self,job,inline=False):
+		if job.dedupe and job.block==self.last_block:
+			job.set_result(1)
+			return
+		delay=self.ready_at-time.monotonic()
+		if delay>0:
+			time.sleep(delay)
+		try:
+			result=job.run()
+		except Exception as ex:
+			job.set_exception(ex)
+			result=None
+		self.ready_at=time.monotonic()+job.gap
+		self.last_block=job.block
+		if job.done():
+			return
+		if job.settle is None:
+			job.set_result(result)
+		elif inline:
+			time.sleep(job.settle)
+			job.settle=None
+			job.run=job.finish
+			self.execute(job,inline)
+		else:
+			job.deadline=time.monotonic()+job.settle
+			job.settle=None
+			job.run=job.finish
+			with self.condition:
+				self.settling=job
+
+scheduler=I2CScheduler()
+
+motion_cmds=set(cmd[0] for cmd in (fwd_cmd,motor_fwd_cmd,bwd_cmd,motor_bwd_cmd,left_cmd,left_rot_cmd,right_cmd,right_rot_cmd))
+motion_directions={fwd_cmd[0]:(1,1),motor_fwd_cmd[0]:(1,1),bwd_cmd[0]:(-1,-1),motor_bwd_cmd[0]:(-1,-1),left_cmd[0]:(0,1),left_rot_cmd[0]:(-1,1),right_cmd[0]:(1,0),right_rot_cmd[0]:(1,-1),stop_cmd[0]:(0,0)}
+speed_cmds=set(cmd[0] for cmd in (m1_cmd,m2_cmd,set_left_speed_cmd,set_right_speed_cmd))
+
+# Run a whole command/wait/read exchange on the bus worker, so no other
+# operation can slip in between the request and the answer
+def i2c_transaction(func):
+	@functools.wraps(func)
+	def run(*args,**kwargs):
+		return scheduler.call(lambda: func(*args,**kwargs))
+	return run
+
+# Commanded wheel directions, 1 forward, -1 backward and 0 stopped,
+# updated as the commands reach the board
+wheel_directions=[0,0]
+encoder_resets=0
+# ([wheel 0 targeted, wheel 1 targeted], pulses) of the last enc_tgt,
+# until the odometry sees it reached
+encoder_target=None
+motion_commands=0
+wheels_lock=threading.Lock()
+
+def track_wheels(block):
+	global encoder_resets,encoder_target,motion_commands
+	command=block[0]
+	with wheels_lock:
+		if command in motion_directions:
+			wheel_directions[:]=motion_directions[command]
+			motion_commands+=1
+		elif command==m1_cmd[0] or command==m2_cmd[0]:
+			wheel_directions[command-m1_cmd[0]]=1 if block[1]==1 else -1
+			motion_commands+=1
+		elif command==enc_tgt_cmd[0]:
+			encoder_resets+=1
+			encoder_target=([block[1]>>1&1,block[1]&1],block[2]*256+block[3])
+		else:
+			return
+	if _odometry is not None:
+		_odometry.moving.set()
+
+def _write_i2c_block(address,block):
 	try:
 		op=bus.write_i2c_block_data(address,1,block)
-		time.sleep(.005)
-		return op
 	except IOError:
 		if debug:
 			print ("IOError")
 		return -1
-	return 1
+	track_wheels(block)
+	return op
 
-#Write a byte to the GoPiGo
-def writeNumber(value):
+#Write I2C block
+#	return: 0 if the write was superseded by a newer one or dropped by stop()
+def write_i2c_block(address,block,gap=None):
+	command=block[0]
+	if command==stop_cmd[0]:
+		return scheduler.call(lambda: _write_i2c_block(address,block),priority=I2CScheduler.STOP,gap=gap,block=tuple(block))
+	key=None
+	if command in motion_cmds:
+		key='motion'
+	elif command in speed_cmds:
+		key=command
+	return scheduler.call(lambda: _write_i2c_block(address,block),priority=I2CScheduler.WRITE,gap=gap,key=key,block=tuple(block),dedupe=command in speed_cmds)
+
+def _writeNumber(value):
 	try:
 		bus.write_byte(address, value)
-		time.sleep(.005)
 	except IOError:
 		if debug:
 			print ("IOError")
 		return -1
 	return 1
 
-#Read a byte from the GoPiGo
-def readByte():
+#Write a byte to the GoPiGo
+def writeNumber(value):
+	return scheduler.call(lambda: _writeNumber(value),priority=I2CScheduler.WRITE)
+
+def _readByte():
 	try:
 		number = bus.read_byte(address)
-		time.sleep(.005)
 	except IOError:
 		if debug:
 			print ("IOError")
 		return -1
 	return number
 
+#Read a byte from the GoPiGo
+def readByte():
+	return scheduler.call(_readByte)
+
+#Read the two byte answer of the last command
+def _read_word():
+	try:
+		b1=bus.read_byte(address)
+		b2=bus.read_byte(address)
+	except IOError:
+		return -1
+	return b1*256+b2
+
 #Control Motor 1
 def motor1(direction,speed):
 	return write_i2c_block(address,m1_cmd+[direction,speed,0])
@@ -231,20 +471,141 @@ def right_rot():
 	return write_i2c_block(address,right_rot_cmd+[0,0,0])
 
 DPR = 360.0/64
+
+# Samples both encoders at a fixed rate on its own thread and integrates
+# them into the distance travelled in cm and the heading in degrees,
+# positive to the right. Callers sleep in wait_turned/wait_travelled
+# instead of polling the encoders. Sampling pauses while the wheels are
+# stopped, including when the firmware stopped them at an encoder
+# target, and slows down to once a second while the counts stand still
+# although the wheels should turn. Encoder counts restart from zero on
+# every enc_tgt.
+class Odometry(object):
+	def __init__(self,rate=5.0,still_samples=3,still_period=1.0):
+		self.period=1.0/rate
+		self.still_samples=still_samples
+		self.still_period=still_period
+		self.still=0
+		self.condition=threading.Condition()
+		self.moving=threading.Event()
+		self.distance=0.0
+		self.heading=0.0
+		self.counts=None
+		self.resets=encoder_resets
+		self.directions=[0,0]
+		# Take the baseline before any turn the caller is about to start
+		self.sample()
+		self.thread=threading.Thread(target=self.run,name='Odometry')
+		self.thread.daemon=True
+		self.thread.start()
+
+	def run(self):
+		deadline=time.monotonic()
+		while True:
+			self.moving.clear()
+			if self.sample()==[0,0]:
+				self.moving.wait()
+				deadline=time.monotonic()
+				continue
+			if self.still>=self.still_samples:
+				self.moving.wait(self.still_period)
+				deadline=time.monotonic()
+				continue
+			deadline+=self.period
+			delay=deadline-time.monotonic()
+			if delay>0:
+				time.sleep(delay)
+			else:
+				deadline=time.monotonic()
+
+	def sample(self):
+		global encoder_target
+		resets=encoder_resets
+		commands=motion_commands
+		reads=[enc_read_async(0),enc_read_async(1)]
+		counts=[read.result() for read in reads]
+		if -1 in counts:
+			return list(wheel_directions)
+		with wheels_lock:
+			# The firmware stops both motors once a targeted wheel gets
+			# there. Counts read before a newer enc_tgt or next to a newer
+			# motion command say nothing about the current target.
+			if (encoder_target is not None and resets==encoder_resets and
+					commands==motion_commands and
+					any(on and count>=encoder_target[1] for on,count in zip(encoder_target[0],counts))):
+				wheel_directions[:]=[0,0]
+				encoder_target=None
+			# Any wheel that moved before the reads has its direction set by now
+			directions=list(wheel_directions)
+		with self.condition:
+			if self.counts is not None:
+				travelled=[]
+				for wheel in (0,1):
+					pulses=counts[wheel]
+					if resets==self.resets and counts[wheel]>=self.counts[wheel]:
+						pulses-=self.counts[wheel]
+					# Pulses counted after a wheel stopped belong to the
+					# direction it was last turning in
+					if directions[wheel]!=0:
+						self.directions[wheel]=directions[wheel]
+					travelled.append(self.directions[wheel]*pulses)
+				self.distance+=(travelled[0]+travelled[1])/2.0/PPR*WHEEL_CIRC
+				self.heading+=(travelled[0]-travelled[1])*DPR
+			if counts==self.counts and resets==self.resets:
+				self.still+=1
+			else:
+				self.still=0
+			self.counts=counts
+			self.resets=resets
+			self.condition.notify_all()
+		return directions
+
+	def pose(self):
+		with self.condition:
+			return self.distance,self.heading
+
+	#Wait until the heading moved by degrees either way from start
+	#	return:	False on timeout
+	def wait_turned(self,degrees,timeout=None,start=None):
+		with self.condition:
+			if start is None:
+				start=self.heading
+			return self.condition.wait_for(lambda: abs(self.heading-start)>=degrees-1e-6,timeout)
+
+	#Wait until the robot travelled cm either way from start
+	#	return:	False on timeout
+	def wait_travelled(self,cm,timeout=None,start=None):
+		with self.condition:
+			if start is None:
+				start=self.distance
+			return self.condition.wait_for(lambda: abs(self.distance-start)>=cm-1e-6,timeout)
+
+_odometry=None
+_odometry_lock=threading.Lock()
+
+#Odometry service, started on first use
+def odometry(rate=5.0):
+	global _odometry
+	with _odometry_lock:
+		if _odometry is None:
+			_odometry=Odometry(rate)
+	return _odometry
+
 # turn x degrees to the right
 def turn_right(degrees):
 	pulse = int(degrees//DPR)
 	enc_tgt(1,0,pulse)
 	right()
 
-def turn_right_wait_for_completion(degrees):
+def turn_right_wait_for_completion(degrees,timeout=None):
 	'''
 	Same as turn_right() but blocking
+	returns False if the turn did not complete within timeout seconds
 	'''
+	start=odometry().pose()[1]
 	turn_right(degrees)
 	pulse = int(degrees//DPR)
-	while enc_read(0) < pulse:
-		pass
+	return odometry().wait_turned(pulse*DPR,timeout,start)
 
 
 # turn x degrees to the left
@@ -253,14 +614,15 @@ def turn_left(degrees):
 	enc_tgt(0,1,pulse)
 	left()
 
-def turn_left_wait_for_completion(degrees):
+def turn_left_wait_for_completion(degrees,timeout=None):
 	'''
 	same as turn_left() but blocking.
+	returns False if the turn did not complete within timeout seconds
 	'''
+	start=odometry().pose()[1]
 	turn_left(degrees)
 	pulse = int(degrees//DPR)
-	while enc_read(1) < pulse:
-		pass
+	return odometry().wait_turned(pulse*DPR,timeout,start)
 
 
 #Stop the GoPiGo
@@ -285,6 +647,7 @@ def trim_test(value):
 	write_i2c_block(address,trim_test_cmd+[value,0,0])
 
 #Read the trim value in	EEPROM if present else return -3
+@i2c_transaction
 def trim_read():
 	write_i2c_block(address,trim_read_cmd+[0,0,0])
 	time.sleep(.08)
@@ -313,6 +676,7 @@ def trim_write(value):
 
 
 # Arduino Digital Read
+@i2c_transaction
 def digitalRead(pin):
 	if pin ==10 or pin ==15 or pin ==0 or pin ==1:
 		write_i2c_block(address, digital_read_cmd + [pin, unused, unused])
@@ -346,6 +710,7 @@ def pinMode(pin, mode):
 		# return -2
 
 # Read analog value from Pin
+@i2c_transaction
 def analogRead(pin):
 	#if pin == 1 :
 	write_i2c_block(address, analog_read_cmd + [pin, unused, unused])
@@ -367,62 +732,55 @@ def analogWrite(pin, value):
 	else:
 		return -2
 
+def _read_volt():
+	v=_read_word()
+	if v==-1:
+		return -1
+	v=(5*float(v)/1024)/0.4
+	return round(v,2)
+
+#Read voltage
+#	return:	a Future resolving to the voltage in V
+def volt_async():
+	return scheduler.exchange(volt_cmd+[0,0,0],.1,_read_volt)
+
 #Read voltage
 #	return:	voltage in V
 def volt():
-	write_i2c_block(address,volt_cmd+[0,0,0])
-	time.sleep(.1)
-	try:
-		b1=bus.read_byte(address)
-		b2=bus.read_byte(address)
-	except IOError:
-		return -1
+	return volt_async().result()
 
-	if b1!=-1 and b2!=-1:
-		v=b1*256+b2
-		v=(5*float(v)/1024)/0.4
-		return round(v,2)
-	else:
-		return -1
+#Read board revision
+#	return:	a Future resolving to the board revision
+def brd_rev_async():
+	return scheduler.exchange(analog_read_cmd+[7,unused,unused],.1,_read_word)
 
 #Read board revision
 #	return:	voltage in V
 def brd_rev():
-	write_i2c_block(address, analog_read_cmd + [7, unused, unused])
-	time.sleep(.1)
-	try:
-		b1=bus.read_byte(address)
-		b2=bus.read_byte(address)
-	except IOError:
-		return -1
-	return b1* 256 + b2
+	return brd_rev_async().result()
+
+#Read ultrasonic sensor
+#	arg:
+#		pin -> 	Pin number on which the US sensor is connected
+#	return:		a Future resolving to the distance in cm
+def us_dist_async(pin):
+	return scheduler.exchange(us_cmd+[pin,0,0],.08,_read_word)
 
 #Read ultrasonic sensor
 #	arg:
 #		pin -> 	Pin number on which the US sensor is connected
 #	return:		distance in cm
 def us_dist(pin):
-	write_i2c_block(address,us_cmd+[pin,0,0])
-	time.sleep(.08)
-	try:
-		b1=bus.read_byte(address)
-		b2=bus.read_byte(address)
-	except IOError:
-		return -1
-	if b1!=-1 and b2!=-1:
-		v=b1*256+b2
-		return v
-	else:
-		return -1
+	return us_dist_async(pin).result()
 
-def corrected_us_dist(pin):
+def correct_us_dist(raw_data):
 	'''
 	based on lab experiments, the US sensor has to be corrected
 	with the following equation:
 		(x+4.41)/1.423
 	This seems to give the best results for the sensors on hand
 	'''
-	raw_data = float(us_dist(pin))
+	raw_data = float(raw_data)
 
 	if raw_data > 0:
 		corrected_data = (raw_data + 4.41)  / 1.423
@@ -430,8 +788,21 @@ def corrected_us_dist(pin):
 		corrected_data = raw_data
 	return int(corrected_data)
 
-def read_motor_speed():
-	write_i2c_block(address,read_motor_speed_cmd+[unused,unused,unused])
+def corrected_us_dist_async(pin):
+	# Shares the raw reading with us_dist_async and corrects it per caller
+	corrected=Future()
+	def correct(raw):
+		if raw.exception() is not None:
+			corrected.set_exception(raw.exception())
+		else:
+			corrected.set_result(correct_us_dist(raw.result()))
+	us_dist_async(pin).add_done_callback(correct)
+	return corrected
+
+def corrected_us_dist(pin):
+	return correct_us_dist(us_dist(pin))
+
+def _read_motor_speeds():
 	try:
 		s1=bus.read_byte(address)
 		s2=bus.read_byte(address)
@@ -439,12 +810,20 @@ def read_motor_speed():
 		return [-1,-1]
 	return [s1,s2]
 
+#Read the motor speeds
+#	return:	a Future resolving to [left speed, right speed]
+def read_motor_speed_async():
+	return scheduler.exchange(read_motor_speed_cmd+[unused,unused,unused],0,_read_motor_speeds)
+
+def read_motor_speed():
+	return read_motor_speed_async().result()
+
 
 #Turn led on
 #	arg:
 #		l_id: 1 for left LED and 0 for right LED
 def led_on(l_id):
-	if version > 14:
+	if board_version() > 14:
 		r_led=16
 		l_led=17
 	else:
@@ -466,7 +845,7 @@ def led_on(l_id):
 #	arg:
 #		l_id: 1 for left LED and 0 for right LED
 def led_off(l_id):
-	if version>14:
+	if board_version()>14:
 		r_led=16
 		l_led=17
 	else:
@@ -508,24 +887,13 @@ def enc_tgt(m1,m2,target):
 #	arg:
 #		motor -> 	0 for motor1 and 1 for motor2
 #	return:		distance in cm
+def enc_read_async(motor):
+	return scheduler.exchange(enc_read_cmd+[motor,0,0],.08,_read_word)
+
 def enc_read(motor):
-	write_i2c_block(address,enc_read_cmd+[motor,0,0])
-	time.sleep(.08)
-	try:
-		b1=bus.read_byte(address)
-		b2=bus.read_byte(address)
-	except IOError:
-		return -1
-	if b1!=-1 and b2!=-1:
-		v=b1*256+b2
-		return v
-	else:
-		return -1
+	return enc_read_async(motor).result()
 
-#Returns the firmware version
-def fw_ver():
-	write_i2c_block(address,fw_ver_cmd+[0,0,0])
-	time.sleep(.1)
+def _read_fw_ver():
 	try:
 		ver=bus.read_byte(address)
 		bus.read_byte(address)		#Empty the buffer
@@ -533,6 +901,14 @@ def fw_ver():
 		return -1
 	return float(ver)/10
 
+#Returns a Future resolving to the firmware version
+def fw_ver_async():
+	return scheduler.exchange(fw_ver_cmd+[0,0,0],.1,_read_fw_ver)
+
+#Returns the firmware version
+def fw_ver():
+	return fw_ver_async().result()
+
 #Enable the encoders (enabled by default)
 def enable_encoders():
 	return write_i2c_block(address,en_enc_cmd+[0,0,0])
@@ -577,8 +953,7 @@ def set_speed(speed):
 		speed =255
 	elif speed <0:
 		speed =0
-	set_left_speed(speed)
-	time.sleep(.1)
+	write_i2c_block(address,set_left_speed_cmd+[speed,0,0],gap=.1)
 	set_right_speed(speed)
 
 #Enable communication time-out(stop the motors if no command received in the specified time-out)
@@ -596,6 +971,7 @@ def disable_com_timeout():
 #					b1-timeout_status
 #	Return:	list with 	l[0]-enc_status
 #						l[1]-timeout_status
+@i2c_transaction
 def read_status():
 	st=bus.read_byte(address)
 	# Karan, can you double check this one?
@@ -615,11 +991,8 @@ def read_timeout_status():
 	st=read_status()
 	return st[1]
 
-# Grove - Infrared Receiver- get the commands received from the Grove IR sensor
-def ir_read_signal():
+def _read_ir_signal():
 	try:
-		write_i2c_block(address,ir_read_cmd+[unused,unused,unused])
-		time.sleep(.1)
 		data_back= bus.read_i2c_block_data(address, 1)[0:21]
 		if data_back[1]!=255:
 			return data_back
@@ -627,13 +1000,20 @@ def ir_read_signal():
 	except IOError:
 		return [-1]*21
 
+# Grove - Infrared Receiver- get the commands received from the Grove IR sensor
+#	return:	a Future resolving to the signal
+def ir_read_signal_async():
+	return scheduler.exchange(ir_read_cmd+[unused,unused,unused],.1,_read_ir_signal)
+
+# Grove - Infrared Receiver- get the commands received from the Grove IR sensor
+def ir_read_signal():
+	return ir_read_signal_async().result()
+
 # Grove - Infrared Receiver- set the pin on which the Grove IR sensor is connected
 def ir_recv_pin(pin):
 	write_i2c_block(address,ir_recv_pin_cmd+[pin,unused,unused])
 
-def cpu_speed():
-	write_i2c_block(address,cpu_speed_cmd+[0,0,0])
-	time.sleep(.1)
+def _read_cpu_speed():
 	try:
 		b1=bus.read_byte(address)
 		b2=bus.read_byte(address)
@@ -641,6 +1021,12 @@ def cpu_speed():
 		return -1
 	return b1
 
+def cpu_speed_async():
+	return scheduler.exchange(cpu_speed_cmd+[0,0,0],.1,_read_cpu_speed)
+
+def cpu_speed():
+	return cpu_speed_async().result()
+
 # Read the DHT sensor connected to the serial port
 def dht(sensor_type=0):
 	try:
@@ -658,10 +1044,16 @@ def dht(sensor_type=0):
 	except RuntimeError:
 		return [-3.0,-3.0]
 
-for i in range(10):
-	raw=analogRead(7)
+#Board version, detected on first use
+#	return:	16 or 14
+def board_version():
+	global version
+	if version is None:
+		for i in range(10):
+			raw=analogRead(7)
 
-if raw>v16_thresh:
-	version=16
-else:
-	version=14
+		if raw>v16_thresh:
+			version=16
+		else:
+			version=14
+	return version
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Author: Gabriel Bustamante
+Email: gabrielbusta@gmail.com
+
+Selfdriving GoPiGo: An open source self-driving robot application.
+This app was built using the GoPiGo robotics platform for the Raspberry Pi.
+
+Copyright (C) 2017 Gabriel Bustamante
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+"""
+import time
+from collections import deque
+import gopigo
+
+
+class SimulatedGoPiGo(object):
+    # In-memory stand-in for the GoPiGo firmware behind an smbus.SMBus.
+    # Motors turn the wheels at a rate proportional to their speed, the
+    # encoders count the pulses, and the ultrasonic sensor sees an
+    # obstacle `distance` cm ahead that gets closer as the robot drives
+    # forward. Plug it in with gopigo.set_bus(SimulatedGoPiGo()).
+    MAX_REVOLUTIONS_PER_SECOND = 1.5
+    BOARD_REVISION = 800
+    FIRMWARE_VERSION = 16
+    CPU_SPEED = 16
+
+    def __init__(self, distance=200.0, voltage=9.0, clock=time.monotonic):
+        self.distance = distance
+        self.voltage = voltage
+        self.clock = clock
+        self.updated = clock()
+        self.speeds = [200, 200]
+        self.directions = [0, 0]
+        self.pulses = [0.0, 0.0]
+        self.targets = [None, None]
+        self.answer = deque()
+
+    def advance(self):
+        now = self.clock()
+        elapsed, self.updated = now - self.updated, now
+
+        travelled = []
+        for motor in (0, 1):
+            rate = (self.MAX_REVOLUTIONS_PER_SECOND * gopigo.PPR *
+                    self.speeds[motor] / 255.0)
+            pulses = rate * elapsed * abs(self.directions[motor])
+            self.pulses[motor] += pulses
+            travelled.append(self.directions[motor] * pulses /
+                             gopigo.PPR * gopigo.WHEEL_CIRC)
+
+        self.distance = max(2.0, self.distance - sum(travelled) / 2)
+
+        # The firmware stops both motors once a targeted encoder gets there.
+        for motor in (0, 1):
+            target = self.targets[motor]
+            if target is not None and self.pulses[motor] >= target:
+                self.directions = [0, 0]
+                self.targets = [None, None]
+                break
+
+    def drive(self, left, right):
+        self.directions = [left, right]
+
+    def respond(self, *values):
+        self.answer = deque(values)
+
+    def respond_word(self, value):
+        value = max(0, min(int(value), 0xffff))
+        self.respond(value // 256, value % 256)
+
+    def write_i2c_block_data(self, address, register, block):
+        self.advance()
+        command, arguments = block[0], block[1:]
+
+        motions = {gopigo.fwd_cmd[0]: (1, 1),
+                   gopigo.motor_fwd_cmd[0]: (1, 1),
+                   gopigo.bwd_cmd[0]: (-1, -1),
+                   gopigo.motor_bwd_cmd[0]: (-1, -1),
+                   gopigo.left_cmd[0]: (0, 1),
+                   gopigo.left_rot_cmd[0]: (-1, 1),
+                   gopigo.right_cmd[0]: (1, 0),
+                   gopigo.right_rot_cmd[0]: (1, -1),
+                   gopigo.stop_cmd[0]: (0, 0)}
+
+        if command in motions:
+            self.drive(*motions[command])
+        elif command == gopigo.ispd_cmd[0]:
+            self.speeds = [min(255, speed + 10) for speed in self.speeds]
+        elif command == gopigo.dspd_cmd[0]:
+            self.speeds = [max(0, speed - 10) for speed in self.speeds]
+        elif command in (gopigo.m1_cmd[0], gopigo.m2_cmd[0]):
+            motor = 0 if command == gopigo.m1_cmd[0] else 1
+            self.directions[motor] = 1 if arguments[0] == 1 else -1
+            self.speeds[motor] = arguments[1]
+        elif command == gopigo.set_left_speed_cmd[0]:
+            self.speeds[0] = arguments[0]
+        elif command == gopigo.set_right_speed_cmd[0]:
+            self.speeds[1] = arguments[0]
+        elif command == gopigo.enc_tgt_cmd[0]:
+            target = arguments[1] * 256 + arguments[2]
+            selected = (arguments[0] >> 1 & 1, arguments[0] & 1)
+            self.pulses = [0.0, 0.0]
+            self.targets = [target if on else None for on in selected]
+        elif command == gopigo.enc_read_cmd[0]:
+            self.respond_word(self.pulses[arguments[0]])
+        elif command == gopigo.read_motor_speed_cmd[0]:
+            self.respond(*self.speeds)
+        elif command == gopigo.volt_cmd[0]:
+            self.respond_word(self.voltage * 0.4 * 1024 / 5)
+        elif command == gopigo.us_cmd[0]:
+            # gopigo.correct_us_dist turns this back into self.distance.
+            self.respond_word(self.distance * 1.423 - 4.41)
+        elif command == gopigo.fw_ver_cmd[0]:
+            self.respond(self.FIRMWARE_VERSION, 0)
+        elif command == gopigo.cpu_speed_cmd[0]:
+            self.respond(self.CPU_SPEED, 0)
+        elif command == gopigo.analog_read_cmd[0]:
+            self.respond_word(self.BOARD_REVISION if arguments[0] == 7 else 0)
+        elif command in (gopigo.digital_read_cmd[0],
+                         gopigo.trim_read_cmd[0]):
+            self.respond(0, 0)
+        elif command == gopigo.ir_read_cmd[0]:
+            self.respond(*([255] * 21))
+
+    def write_byte(self, address, value):
+        pass
+
+    def read_byte(self, address):
+        return self.answer.popleft() if self.answer else 0
+
+    def read_i2c_block_data(self, address, register):
+        data = list(self.answer) + [0] * 32
+        self.answer.clear()
+        return data[:32]
@@ -21,7 +21,9 @@ along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
 """
 import logging
 import settings
-from utils import RemoteControl
+from utils import RemoteControl, UltrasonicSubscriber
+from recording import StreamRecorder
+from pipeline import run_pipeline
 from plumbum import colors
 from cvutils import *
 
@@ -30,24 +32,112 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+def create_analysis(shape, profiler=None):
+    return Analysis(shape,
+                    'stop-sign-haar-cascade.xml',
+                    'speed-sign-haar-cascade.xml',
+                    preallocate=True,
+                    detection_workers=settings.ANALYSIS_WORKERS,
+                    stop_roi=settings.STOP_SIGN_ROI,
+                    stop_min_size=settings.STOP_SIGN_MIN_SIZE,
+                    stop_max_size=settings.STOP_SIGN_MAX_SIZE,
+                    stop_downscale=settings.STOP_SIGN_DOWNSCALE,
+                    speed_roi=settings.SPEED_SIGN_ROI,
+                    speed_min_size=settings.SPEED_SIGN_MIN_SIZE,
+                    speed_max_size=settings.SPEED_SIGN_MAX_SIZE,
+                    speed_downscale=settings.SPEED_SIGN_DOWNSCALE,
+                    sign_detection_interval=settings.SIGN_DETECTION_INTERVAL,
+                    shared_pyramid=settings.SHARED_SIGN_PYRAMID,
+                    change_threshold=settings.SIGN_CHANGE_THRESHOLD,
+                    max_reuse_age=settings.SIGN_REUSE_MAX_AGE,
+                    profiler=profiler)
+
+
+def run_in_processes(url, recorder):
+    remote_control = None
+    if not settings.REPLAY_PATH:
+        remote_control = RemoteControl(
+            settings.ROBOT_IP,
+            settings.REMOTE_CONTROL_PORT,
+            coalesce=settings.REMOTE_CONTROL_COALESCE,
+            acknowledge=settings.REMOTE_CONTROL_ACKS).start()
+        logger.debug('Established remote control connection.')
+
+    print(colors.green & colors.bold |
+          '\n *******************************\n'
+            ' *                             *\n'
+            ' *      PRESS "q" TO QUIT      *\n'
+            ' *                             *\n'
+            ' *******************************\n')
+
+    lossless = bool(settings.REPLAY_PATH) and settings.REPLAY_MODE == 'fast'
+    run_pipeline(url, create_analysis, settings.PIPELINE_RING_DEPTH,
+                 lossless)
+
+    if remote_control is not None:
+        remote_control.shutdown()
+    if recorder is not None:
+        recorder.shutdown()
+
+
 def main():
-    url = 'tcp://{}:{}'.format(settings.ROBOT_IP, settings.CAMERA_PORT)
-    video_stream = VideoStream(url).start()
-    streaming, frame = video_stream.read()
+    scheme = 'luma' if settings.CAMERA_VIDEO_FORMAT == 'luma' else 'tcp'
+    url = '{}://{}:{}'.format(scheme, settings.ROBOT_IP, settings.CAMERA_PORT)
+    recorder = None
+    remote_control = None
+
+    if settings.REPLAY_PATH:
+        url = 'replay://{}?mode={}'.format(settings.REPLAY_PATH,
+                                           settings.REPLAY_MODE)
+        logger.debug('Replaying {}.'.format(settings.REPLAY_PATH))
+    elif settings.RECORD_PATH:
+        recorder = StreamRecorder(settings.ROBOT_IP,
+                                  settings.CAMERA_PORT,
+                                  settings.RECORD_PATH,
+                                  settings.CAMERA_VIDEO_FORMAT).start()
+        url = recorder.url
+        logger.debug('Recording to {}.'.format(settings.RECORD_PATH))
+
+    if settings.PIPELINE_MODE == 'processes':
+        run_in_processes(url, recorder)
+        return
+
+    lossless = bool(settings.REPLAY_PATH) and settings.REPLAY_MODE == 'fast'
+    video_stream = VideoStream(url, settings.FRAME_RING_DEPTH,
+                               lossless).start()
+    streaming, slot, frame = video_stream.borrow_next(settings.FRAME_TIMEOUT)
     logger.debug('Video stream started.')
 
-    remote_control = RemoteControl(settings.ROBOT_IP,
-                                   settings.REMOTE_CONTROL_PORT).start()
-    logger.debug('Established remote control connection.')
+    # A replayed run has no robot to drive.
+    ultrasonic = None
+    if not settings.REPLAY_PATH:
+        ultrasonic = UltrasonicSubscriber(
+            settings.ROBOT_IP,
+            settings.ULTRASONIC_SENSOR_PORT).start()
+        logger.debug('Subscribed to ultrasonic telemetry.')
+
+        remote_control = RemoteControl(
+            settings.ROBOT_IP,
+            settings.REMOTE_CONTROL_PORT,
+            coalesce=settings.REMOTE_CONTROL_COALESCE,
+            acknowledge=settings.REMOTE_CONTROL_ACKS).start()
+        logger.debug('Established remote control connection.')
+
+    profiler = StageProfiler(settings.PROFILER_REPORT_INTERVAL)
 
-    analysis = Analysis(frame.shape,
-                        'stop-sign-haar-cascade.xml',
-                        'speed-sign-haar-cascade.xml')
+    analysis = create_analysis(frame.shape, profiler)
 
     logger.debug('Sucessfully initialized '
                  'image analysis control object.')
 
-    display = Display()
+    quality = None
+    if settings.QUALITY_FRAME_BUDGET is not None:
+        quality = QualityController(analysis,
+                                    settings.QUALITY_FRAME_BUDGET,
+                                    settings.QUALITY_LADDER)
+
+    display = Display(mode=settings.DISPLAY_MODE,
+                      render_every=settings.DISPLAY_RENDER_EVERY)
 
     logger.debug('Sucessfully initialized display manager boundary object.')
 
@@ -60,40 +150,73 @@ def main():
             ' *                             *\n'
             ' *******************************\n')
 
-    fps_timer = FPSTimer().start()
+    profiler.start()
 
     # MAIN LOOP #
     while streaming:
+        profiler.begin_frame()
+        if quality is not None:
+            quality.begin_frame()
         grayed = analysis.gray_scale(frame)
+        profiler.mark('gray_scale')
         blurred = analysis.gaussian_blur(grayed)
-
-        lanes = analysis.detect_lanes(blurred)
-        speed_signs = analysis.detect_speed_signs(blurred)
-        stop_signs = analysis.detect_stop_signs(blurred)
-
-        display.draw_lanes(frame, lanes)
-        display.draw_speed_signs(frame, speed_signs)
-        display.draw_stop_signs(frame, stop_signs)
-        display.show(frame)
-
-        if display.get_key_pressed() == 'q':
+        profiler.mark('gaussian_blur')
+
+        detections = analysis.detect(blurred)
+        profiler.mark('detect')
+        lane_model = analysis.fit_lanes(detections.lanes)
+        profiler.mark('fit_lanes')
+
+        # Median distance of the newest telemetry sample, never blocks.
+        distance = None
+        if ultrasonic is not None:
+            sample = ultrasonic.read()
+            if sample is not None:
+                distance = sample[1]
+
+        display.render(frame, detections, lane_model, distance)
+        profiler.mark('render')
+
+        key = display.get_key_pressed()
+        profiler.mark('wait_key')
+        if key == 'q':
             break
+        # Waiting for the camera does not count against the budget.
+        if quality is not None:
+            quality.end_frame()
+
+        video_stream.give_back(slot)
+        streaming, slot, frame = video_stream.borrow_next(
+            settings.FRAME_TIMEOUT)
+        while streaming and frame is None and not display.interrupted:
+            logger.warn(colors.yellow & colors.bold |
+                        'No new frame after {} seconds.'
+                        .format(settings.FRAME_TIMEOUT))
+            streaming, slot, frame = video_stream.borrow_next(
+                settings.FRAME_TIMEOUT)
+        if display.interrupted:
+            break
+        profiler.mark('capture')
+        profiler.end_frame()
 
-        streaming, frame = video_stream.read()
-        fps_timer.update()
-
-    fps_timer.stop()
+    profiler.stop()
 
     logger.info(colors.blue & colors.bold |
                 'Elasped time = {:.2f}'
-                .format(fps_timer.elapsed()))
+                .format(profiler.elapsed()))
 
     logger.info(colors.blue & colors.bold |
-                'Approx. FPS = {:.2f}'.format(fps_timer.fps()))
+                'Approx. FPS = {:.2f}'.format(profiler.fps()))
 
-    remote_control.shutdown()
+    if remote_control is not None:
+        remote_control.shutdown()
+    if ultrasonic is not None:
+        ultrasonic.shutdown()
+    analysis.release()
     display.destroy_windows()
     video_stream.release()
+    if recorder is not None:
+        recorder.shutdown()
 
 
 if __name__ == '__main__':
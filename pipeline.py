@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Author: Gabriel Bustamante
+Email: gabrielbusta@gmail.com
+
+Selfdriving GoPiGo: An open source self-driving robot application.
+This app was built using the GoPiGo robotics platform for the Raspberry Pi.
+
+Copyright (C) 2017 Gabriel Bustamante
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+"""
+import sys
+import time
+import logging
+import numpy as np
+import settings
+from plumbum import colors
+from threading import Thread
+from multiprocessing import (Event, Pipe, Process, Queue, queues,
+                             resource_tracker, shared_memory)
+from cvutils import Display, StageProfiler, open_capture
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Seconds a stage waits on its input queue before checking for shutdown.
+POLL_INTERVAL = 0.1
+
+# Sent down `frames` and `results` when the stream ends, so every stage
+# drains what is already queued before it stops.
+END_OF_STREAM = None
+
+
+class SharedFrameRing(object):
+    # Fixed frame slots in one shared memory block. Only slot numbers
+    # travel between processes; whoever holds a slot number owns the slot
+    # until it hands the number on or puts it back on the free queue.
+    def __init__(self, shape, depth, name=None):
+        self.shape = tuple(shape)
+        self.depth = depth
+        frame_size = int(np.prod(self.shape))
+        if name is None:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=frame_size * depth)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # Attaching registers the block with this process's resource
+            # tracker, which would unlink it when the process exits. Only
+            # the parent that created it unlinks it.
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        self.slots = np.ndarray((depth,) + self.shape, np.uint8,
+                                buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        # Views into the buffer must be gone before it can be closed.
+        del self.slots
+        self.memory.close()
+
+    def unlink(self):
+        # Children sharing this process's tracker took the registration
+        # back when they attached; unlink() expects to find it.
+        resource_tracker.register(self.memory._name, 'shared_memory')
+        self.memory.unlink()
+
+
+def take_oldest(queue):
+    try:
+        return queue.get_nowait()
+    except queues.Empty:
+        return None
+
+
+def put_dropping_oldest(queue, message, free_slots):
+    # Never block a producer: when the consumer is behind, the oldest
+    # queued frame is dropped and its slot recycled.
+    dropped = 0
+    while True:
+        try:
+            queue.put_nowait(message)
+            return dropped
+        except queues.Full:
+            stale = take_oldest(queue)
+            if stale is not None:
+                free_slots.put(stale[0])
+                dropped += 1
+
+
+def put_waiting(queue, message, shutdown_request):
+    # Blocks until the consumer makes room, unless the pipeline is asked
+    # to stop first.
+    while not shutdown_request.is_set():
+        try:
+            queue.put(message, timeout=POLL_INTERVAL)
+            return True
+        except queues.Full:
+            pass
+    return False
+
+
+def capture_stage(url, layout, depth, free_slots, frames, shutdown_request,
+                  lossless=False):
+    # The ring is sized from the first decoded frame: its shape goes to
+    # the parent over `layout`, which answers with the ring's name. A
+    # lossless capture waits for analysis instead of dropping frames,
+    # e.g. to replay a recording as fast as the analysis can go.
+    stream = open_capture(url)
+    streaming, first = stream.read()
+    if not streaming:
+        logger.error(colors.red |
+                     'Capture process could not read a frame from {}'
+                     .format(url))
+        layout.send(None)
+        shutdown_request.set()
+        stream.release()
+        return
+    layout.send(first.shape)
+    ring = SharedFrameRing(first.shape, depth, layout.recv())
+    slot = free_slots.get()
+    ring.slots[slot][...] = first
+    sequence = 1
+    dropped = 0
+    try:
+        while True:
+            message = (slot, sequence, time.monotonic())
+            if lossless:
+                if not put_waiting(frames, message, shutdown_request):
+                    break
+            else:
+                dropped += put_dropping_oldest(frames, message, free_slots)
+
+            slot = None
+            while slot is None and not shutdown_request.is_set():
+                slot = take_oldest(free_slots)
+                if slot is None and not lossless:
+                    # Every slot is in flight: reclaim the oldest frame
+                    # that is still waiting for analysis.
+                    stale = take_oldest(frames)
+                    if stale is not None:
+                        slot = stale[0]
+                        dropped += 1
+                if slot is None:
+                    try:
+                        slot = free_slots.get(timeout=POLL_INTERVAL)
+                    except queues.Empty:
+                        pass
+            if slot is None:
+                break
+
+            streaming, frame = stream.read(ring.slots[slot])
+            if not streaming:
+                break
+            if frame is not ring.slots[slot]:
+                if frame.shape != ring.shape:
+                    logger.error(colors.red |
+                                 'Capture process: frame shape changed '
+                                 'from {} to {}'.format(ring.shape,
+                                                        frame.shape))
+                    break
+                ring.slots[slot][...] = frame
+            sequence += 1
+    finally:
+        # Unless the pipeline is already stopping, analysis and display
+        # work through the frames still queued and then stop.
+        put_waiting(frames, END_OF_STREAM, shutdown_request)
+        stream.release()
+        ring.close()
+        logger.info(colors.blue & colors.bold |
+                    'Capture process: {} frames, {} dropped before analysis'
+                    .format(sequence, dropped))
+
+
+def analysis_stage(create_analysis, ring_name, shape, depth, free_slots,
+                   frames, results, shutdown_request, lossless=False):
+    ring = SharedFrameRing(shape, depth, ring_name)
+    profiler = StageProfiler(settings.PROFILER_REPORT_INTERVAL).start()
+    analysis = create_analysis(shape, profiler)
+    dropped = 0
+    drained = False
+    try:
+        while not shutdown_request.is_set():
+            try:
+                message = frames.get(timeout=POLL_INTERVAL)
+            except queues.Empty:
+                continue
+            if message is END_OF_STREAM:
+                drained = put_waiting(results, END_OF_STREAM,
+                                      shutdown_request)
+                break
+            slot, sequence, timestamp = message
+
+            profiler.begin_frame()
+            grayed = analysis.gray_scale(ring.slots[slot])
+            blurred = analysis.gaussian_blur(grayed)
+            detections = analysis.detect(blurred)
+            lane_model = analysis.fit_lanes(detections.lanes)
+            profiler.mark('analysis')
+            profiler.record('latency',
+                            int((time.monotonic() - timestamp) * 1e9))
+            profiler.end_frame()
+
+            message = (slot, sequence, detections, lane_model)
+            if lossless:
+                put_waiting(results, message, shutdown_request)
+            else:
+                dropped += put_dropping_oldest(results, message, free_slots)
+    finally:
+        # Display stops the pipeline once it has drained the results.
+        if not drained:
+            shutdown_request.set()
+        profiler.stop()
+        analysis.release()
+        ring.close()
+        logger.info(colors.blue & colors.bold |
+                    'Analysis process: {:.2f} FPS, {} dropped before display'
+                    .format(profiler.fps(), dropped))
+
+
+def display_stage(ring_name, shape, depth, free_slots, results,
+                  shutdown_request):
+    ring = SharedFrameRing(shape, depth, ring_name)
+    display = Display(mode=settings.DISPLAY_MODE,
+                      render_every=settings.DISPLAY_RENDER_EVERY)
+    display.create_windows()
+    try:
+        while not shutdown_request.is_set():
+            try:
+                message = results.get(timeout=POLL_INTERVAL)
+            except queues.Empty:
+                continue
+            if message is END_OF_STREAM:
+                break
+            slot, _, detections, lane_model = message
+            display.render(ring.slots[slot], detections, lane_model)
+            free_slots.put(slot)
+            if display.get_key_pressed() == 'q':
+                break
+    finally:
+        shutdown_request.set()
+        display.destroy_windows()
+        ring.close()
+
+
+def read_quit_key(shutdown_request):
+    # Child processes get /dev/null as stdin, so in headless mode the
+    # parent takes the "q" key and asks every stage to stop.
+    for line in sys.stdin:
+        if line.strip().startswith('q'):
+            shutdown_request.set()
+            return
+
+
+def run_pipeline(url, create_analysis, depth=8, lossless=False):
+    # Capture/decode, analysis and display each run in their own process.
+    # Frames stay in the shared ring; the queues carry slot numbers and
+    # the (small) detection results. A lossless pipeline blocks instead
+    # of dropping frames between stages.
+    free_slots = Queue()
+    for slot in range(depth):
+        free_slots.put(slot)
+    frames = Queue(maxsize=max(depth // 2, 1))
+    results = Queue(maxsize=max(depth // 4, 1))
+    shutdown_request = Event()
+
+    layout, capture_layout = Pipe()
+    capture = Process(target=capture_stage, name='CaptureProcess',
+                      args=(url, capture_layout, depth, free_slots, frames,
+                            shutdown_request, lossless))
+    capture.start()
+    capture_layout.close()
+    try:
+        shape = layout.recv()
+    except EOFError:
+        shape = None
+    if shape is None:
+        capture.join()
+        return
+    ring = SharedFrameRing(shape, depth)
+    layout.send(ring.name)
+
+    processes = [
+        capture,
+        Process(target=analysis_stage, name='AnalysisProcess',
+                args=(create_analysis, ring.name, shape, depth, free_slots,
+                      frames, results, shutdown_request, lossless)),
+        Process(target=display_stage, name='DisplayProcess',
+                args=(ring.name, shape, depth, free_slots, results,
+                      shutdown_request))
+    ]
+    for process in processes[1:]:
+        process.start()
+    if settings.DISPLAY_MODE == 'headless':
+        Thread(target=read_quit_key, args=(shutdown_request,),
+               name='KeyListener', daemon=True).start()
+
+    try:
+        shutdown_request.wait()
+    except KeyboardInterrupt:
+        shutdown_request.set()
+
+    for process in processes:
+        process.join()
+    ring.close()
+    ring.unlink()
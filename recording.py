@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Author: Gabriel Bustamante
+Email: gabrielbusta@gmail.com
+
+Selfdriving GoPiGo: An open source self-driving robot application.
+This app was built using the GoPiGo robotics platform for the Raspberry Pi.
+
+Copyright (C) 2017 Gabriel Bustamante
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+"""
+import socket
+import time
+import logging
+import datetime
+import cv2
+import numpy as np
+from plumbum import colors
+from threading import Lock, Thread
+from utils import LUMA_HEADER
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+
+# A recording is the camera byte stream exactly as it arrived, plus a
+# sidecar index (recording path + '.idx'). The index starts with a
+# '# <format> <wall clock start>' line followed by one
+# '<byte offset> <seconds since start>' line per frame.
+def index_path(path):
+    return path + '.idx'
+
+
+def load_index(path):
+    offsets = []
+    timestamps = []
+    with open(index_path(path)) as index:
+        stream_format = index.readline().split()[1]
+        for line in index:
+            offset, timestamp = line.split()
+            offsets.append(int(offset))
+            timestamps.append(float(timestamp))
+    return stream_format, offsets, timestamps
+
+
+class H264Indexer(object):
+    # Finds the byte offset of every access unit in an Annex B H.264
+    # stream fed in arbitrary chunks. A frame starts at the first NAL unit
+    # (access unit delimiter, SEI, SPS or slice) that does not follow
+    # another frame header.
+    FRAME_HEADERS = (6, 7, 8, 9)
+    FRAME_STARTS = (1, 5, 6, 7, 9)
+
+    def __init__(self):
+        self.tail = b''
+        self.previous_type = None
+
+    def feed(self, chunk, offset):
+        data = self.tail + chunk
+        base = offset - len(self.tail)
+        frames = []
+        examined = 0
+        position = data.find(b'\x00\x00\x01')
+        while position != -1 and position + 3 < len(data):
+            nal_type = data[position + 3] & 0x1f
+            if (nal_type in self.FRAME_STARTS and
+                    self.previous_type not in self.FRAME_HEADERS):
+                start = position
+                if position > 0 and data[position - 1] == 0:
+                    start -= 1
+                frames.append(base + start)
+            self.previous_type = nal_type
+            examined = position + 1
+            position = data.find(b'\x00\x00\x01', position + 3)
+        self.tail = data[max(len(data) - 4, examined):]
+        return frames
+
+
+class LumaIndexer(object):
+    # Frame offsets of the length-prefixed raw luma stream.
+    def __init__(self):
+        self.next_frame = 0
+        self.header = b''
+
+    def feed(self, chunk, offset):
+        frames = []
+        end = offset + len(chunk)
+        # A header may straddle two chunks; keep its first part until the
+        # rest arrives.
+        while self.next_frame + len(self.header) < end:
+            if not self.header:
+                frames.append(self.next_frame)
+            start = self.next_frame + len(self.header) - offset
+            needed = LUMA_HEADER.size - len(self.header)
+            self.header += chunk[start:start + needed]
+            if len(self.header) < LUMA_HEADER.size:
+                break
+            _, _, length = LUMA_HEADER.unpack(self.header)
+            self.next_frame += LUMA_HEADER.size + length
+            self.header = b''
+        return frames
+
+
+class StreamRecorder(object):
+    # Relay between the robot camera and the local VideoStream. Every
+    # byte received from the robot is forwarded unchanged, appended to
+    # `path` and indexed with its arrival time. Point VideoStream at
+    # `recorder.url` instead of the robot.
+    def __init__(self, ip, port, path, stream_format='h264'):
+        self.ip = ip
+        self.port = port
+        self.path = path
+        self.stream_format = stream_format
+        self.indexer = (LumaIndexer() if stream_format == 'luma'
+                        else H264Indexer())
+        self.shutdown_request = False
+        # Sockets relay() may be blocked on, hung up by shutdown().
+        self.lock = Lock()
+        self.sockets = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+
+    @property
+    def url(self):
+        scheme = 'luma' if self.stream_format == 'luma' else 'tcp'
+        return '{}://127.0.0.1:{}'.format(scheme,
+                                          self.listener.getsockname()[1])
+
+    def start(self):
+        self.thread = Thread(target=self.relay, name='StreamRecorder')
+        self.thread.start()
+        return self
+
+    def watch(self, connection):
+        # False if shutdown() already ran; the caller must close it then.
+        with self.lock:
+            if self.shutdown_request:
+                return False
+            self.sockets.append(connection)
+            return True
+
+    def relay(self):
+        try:
+            client, _ = self.listener.accept()
+        except OSError:
+            return
+        upstream = None
+        start = time.monotonic()
+        offset = 0
+        frames = 0
+
+        with open(self.path, 'wb') as recording, \
+                open(index_path(self.path), 'w') as index:
+            index.write('# {} {}\n'.format(self.stream_format,
+                                           datetime.datetime.now()
+                                           .isoformat()))
+            try:
+                if not self.watch(client):
+                    return
+                upstream = socket.create_connection((self.ip, self.port))
+                if not self.watch(upstream):
+                    return
+                while not self.shutdown_request:
+                    chunk = upstream.recv(65536)
+                    if not chunk:
+                        break
+                    arrival = time.monotonic() - start
+                    client.sendall(chunk)
+                    recording.write(chunk)
+                    for frame_offset in self.indexer.feed(chunk, offset):
+                        index.write('{} {:.6f}\n'.format(frame_offset,
+                                                         arrival))
+                        frames += 1
+                    offset += len(chunk)
+            except OSError as ex:
+                logger.warn(colors.yellow & colors.bold |
+                            'StreamRecorder {}'.format(ex))
+            finally:
+                if upstream is not None:
+                    upstream.close()
+                client.close()
+
+        logger.info(colors.blue & colors.bold |
+                    'Recorded {} frames ({} bytes) to {}'
+                    .format(frames, offset, self.path))
+
+    def shutdown(self):
+        # Hanging up wakes relay() from accept() or recv().
+        with self.lock:
+            self.shutdown_request = True
+            for connection in [self.listener] + self.sockets:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.thread.join()
+        self.listener.close()
+
+
+class ReplayCapture(object):
+    # Plays a recording back through the subset of the cv2.VideoCapture
+    # interface VideoStream uses. In 'realtime' mode frames are released
+    # at their recorded arrival times, in 'fast' mode as soon as they are
+    # decoded. seek() jumps to a frame number in either mode.
+    def __init__(self, path, mode='realtime', start_frame=0):
+        self.path = path
+        self.mode = mode
+        self.stream_format, self.offsets, self.timestamps = load_index(path)
+        self.lock = Lock()
+        self.capture = None
+        self.recording = None
+        self.position = 0
+        self.anchor = None
+        self.header = bytearray(LUMA_HEADER.size)
+        self.open()
+        self.seek(start_frame)
+
+    def open(self):
+        if self.stream_format == 'luma':
+            self.recording = open(self.path, 'rb')
+        else:
+            self.capture = cv2.VideoCapture(self.path)
+        self.position = 0
+
+    def seek(self, frame_number):
+        with self.lock:
+            frame_number = max(0, min(frame_number, len(self.offsets)))
+            if self.stream_format != 'luma':
+                # H.264 is decoded from the start of the recording; only
+                # grab() the frames being skipped, without converting them.
+                if frame_number < self.position:
+                    self.capture.release()
+                    self.open()
+                while self.position < frame_number:
+                    if not self.capture.grab():
+                        break
+                    self.position += 1
+            else:
+                self.position = frame_number
+            self.anchor = None
+
+    def wait_for_frame(self):
+        if self.mode != 'realtime' or self.position >= len(self.timestamps):
+            return
+        timestamp = self.timestamps[self.position]
+        if self.anchor is None:
+            self.anchor = time.monotonic() - timestamp
+        delay = self.anchor + timestamp - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def read_luma(self, image):
+        if self.position >= len(self.offsets):
+            return False, None
+        self.recording.seek(self.offsets[self.position])
+        if self.recording.readinto(self.header) != LUMA_HEADER.size:
+            return False, None
+        width, height, length = LUMA_HEADER.unpack(self.header)
+        if image is None or image.shape != (height, width):
+            image = np.empty((height, width), np.uint8)
+        if self.recording.readinto(memoryview(image).cast('B')) != length:
+            return False, None
+        return True, image
+
+    def read(self, image=None):
+        with self.lock:
+            self.wait_for_frame()
+            if self.stream_format == 'luma':
+                reading, image = self.read_luma(image)
+            else:
+                reading, image = self.capture.read(image)
+            if reading:
+                self.position += 1
+            return reading, image
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+        if self.recording is not None:
+            self.recording.close()
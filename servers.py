@@ -19,13 +19,17 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
 """
+import time
 import socket
+import asyncio
 import gopigo
 import settings
+from gopigo_sim import SimulatedGoPiGo
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from plumbum import colors
-from picamera import PiCamera
-from utils import Server
+from utils import (ACK_FRAME, ACK_REQUESTED, COMMAND_FRAME, OPCODES,
+                   TELEMETRY_SAMPLE, LumaFrameWriter, UltrasonicSampler)
 
 
 logger = logging.getLogger(__name__)
@@ -33,85 +37,255 @@ logging.basicConfig(level=logging.DEBUG)
 
 
 def main():
+    if settings.GOPIGO_BUS == 'simulated':
+        gopigo.set_bus(SimulatedGoPiGo())
     logger.info('Servers waiting for external connections. Run "main.py" on client.')
-    camera_server = Server('',
-                           settings.CAMERA_PORT,
-                           camera_handle,
-                           name='CameraServer').start()
-
-    remote_control_server = Server('',
-                                   settings.REMOTE_CONTROL_PORT,
-                                   remote_control_handle,
-                                   name='RemoteControlServer').start()
-
-    print(colors.green & colors.bold |
-          '\n *******************************\n'
-            ' *                             *\n'
-            ' *     PRESS ENTER TO QUIT     *\n'
-            ' *                             *\n'
-            ' *******************************\n')
-
-    input()
-    camera_server.shutdown()
-    remote_control_server.shutdown()
-
-
-# Each handle is executed in it's own independent process.
-def remote_control_handle(connection, shutdown_request, addr):
-    logger = logging.getLogger('RemoteControlHandle')
-    logging.basicConfig(level=logging.DEBUG)
-    commands = {
-        'fwd': gopigo.fwd,
-        'bwd': gopigo.bwd,
-        'left': gopigo.left,
-        'right': gopigo.right,
-        'stop': gopigo.stop
-    }
-
-    logger.info(colors.blue & colors.bold |
-                'Listening to remote control commands from {}'
-                .format(addr))
-
-    while not shutdown_request.is_set():
-        message = connection.recv(1024).decode()
-        if not message:
-            break
-        command = commands[message]
-        command()
-
-    logger.warn(colors.yellow & colors.bold |
-                'Stopped listening to remote control commands from {}'
-                .format(addr))
-
-
-# Each handle is executed in it's own independent process.
-def camera_handle(connection, shutdown_request, addr):
-    logger = logging.getLogger('CameraHandle')
-    logging.basicConfig(level=logging.DEBUG)
-    stream = connection.makefile('wb')
+    asyncio.run(RobotServer().serve())
+
+
+class StreamOutput(object):
+    # File-like object PiCamera can record into from its own thread. The
+    # data is copied and handed to the event loop, which owns the socket.
+    # A client that lets more than `buffer_limit` bytes pile up is cut
+    # off; dropping part of the stream would corrupt it anyway.
+    def __init__(self, loop, writer, buffer_limit):
+        self.loop = loop
+        self.writer = writer
+        self.buffer_limit = buffer_limit
+
+    def write(self, data):
+        self.loop.call_soon_threadsafe(self.send, bytes(data))
+        return len(data)
+
+    def send(self, data):
+        transport = self.writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > self.buffer_limit:
+            logger.warn(colors.yellow & colors.bold |
+                        'Camera client fell {} bytes behind, disconnecting.'
+                        .format(transport.get_write_buffer_size()))
+            transport.abort()
+            return
+        self.writer.write(data)
+
+    def flush(self):
+        pass
+
+
+def start_camera(stream):
+    # Imported here so the servers start on machines without a camera.
+    from picamera import PiCamera
     camera = PiCamera()
     camera.framerate = settings.CAMERA_FRAMERATE
     camera.resolution = settings.CAMERA_RESOLUTION
     camera.rotation = settings.CAMERA_ROTATION
 
-    camera.start_recording(stream, format=settings.CAMERA_VIDEO_FORMAT)
-    logger.info(colors.blue & colors.bold |
-                'Streaming video to {}'
-                .format(addr))
+    if settings.CAMERA_VIDEO_FORMAT == 'luma':
+        output = LumaFrameWriter(stream, settings.CAMERA_RESOLUTION)
+        camera.start_recording(output, format='yuv')
+    else:
+        camera.start_recording(stream, format=settings.CAMERA_VIDEO_FORMAT)
+    return camera
+
+
+def stop_camera(camera):
     try:
-        while not shutdown_request.is_set():
-            camera.wait_recording(1)
+        camera.stop_recording()
     except Exception as ex:
-            logger.warn(colors.yellow & colors.bold | str(ex))
+        logger.warn(colors.yellow & colors.bold | str(ex))
     finally:
         try:
             camera.close()
         except Exception as ex:
             logger.warn(colors.yellow & colors.bold | str(ex))
 
-    logger.info(colors.blue & colors.bold |
-                'Stopped stream video to {}'
-                .format(addr))
+
+class RobotServer(object):
+    # Serves the camera, remote control and ultrasonic telemetry endpoints
+    # from one event loop. Every endpoint accepts new connections at any
+    # time; a new camera client takes the camera over from the old one.
+    # Blocking GoPiGo calls run on a single hardware thread so I2C access
+    # stays serialized, and blocking camera calls on the default executor.
+    def __init__(self):
+        self.hardware = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='Hardware')
+        self.camera_task = None
+        self.handlers = set()
+        # gopigo serializes every I2C access itself and lets drive commands
+        # through while a reading settles, so sampling stays off the
+        # hardware thread.
+        self.ultrasonic = UltrasonicSampler(self.read_ultrasonic,
+                                            settings.ULTRASONIC_SAMPLE_RATE,
+                                            settings.ULTRASONIC_HISTORY)
+
+    def read_ultrasonic(self):
+        return gopigo.corrected_us_dist_async(
+            settings.ULTRASONIC_SENSOR_PIN).result()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.ultrasonic.start()
+        servers = [
+            await asyncio.start_server(self.track(self.camera_handle), '',
+                                       settings.CAMERA_PORT),
+            await asyncio.start_server(self.track(self.remote_control_handle),
+                                       '', settings.REMOTE_CONTROL_PORT),
+            await asyncio.start_server(self.track(self.ultrasonic_handle), '',
+                                       settings.ULTRASONIC_SENSOR_PORT)
+        ]
+
+        print(colors.green & colors.bold |
+              '\n *******************************\n'
+                ' *                             *\n'
+                ' *     PRESS ENTER TO QUIT     *\n'
+                ' *                             *\n'
+                ' *******************************\n')
+
+        await loop.run_in_executor(None, input)
+
+        # Nothing may queue a drive command behind the final stop, so the
+        # listeners close and the handlers are cancelled first. wait_closed
+        # blocks until every connection is gone, so it comes last.
+        for server in servers:
+            server.close()
+        handlers = list(self.handlers)
+        for handler in handlers:
+            handler.cancel()
+        await loop.run_in_executor(self.hardware, gopigo.stop)
+        await asyncio.gather(*handlers, return_exceptions=True)
+        for server in servers:
+            await server.wait_closed()
+        await loop.run_in_executor(None, self.ultrasonic.shutdown)
+        self.hardware.shutdown()
+
+    def track(self, handle):
+        # Keeps every connection handler reachable so shutdown can cancel
+        # it; the handlers close their writers on the way out. The
+        # cancellation ends here, since asyncio would log it as an error.
+        async def tracked(reader, writer):
+            task = asyncio.current_task()
+            self.handlers.add(task)
+            try:
+                await handle(reader, writer)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.handlers.discard(task)
+        return tracked
+
+    async def camera_handle(self, reader, writer):
+        logger = logging.getLogger('CameraHandle')
+        addr = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+
+        if self.camera_task is not None:
+            logger.warn(colors.yellow & colors.bold |
+                        'Camera taken over by {}'.format(addr))
+            self.camera_task.cancel()
+            await asyncio.gather(self.camera_task, return_exceptions=True)
+        self.camera_task = asyncio.current_task()
+
+        camera = None
+        try:
+            camera = await loop.run_in_executor(
+                None, start_camera,
+                StreamOutput(loop, writer, settings.CAMERA_BUFFER_LIMIT))
+            logger.info(colors.blue & colors.bold |
+                        'Streaming video to {}'
+                        .format(addr))
+            # The client never sends anything; EOF means it went away.
+            await reader.read()
+        except Exception as ex:
+            logger.warn(colors.yellow & colors.bold | str(ex))
+        finally:
+            if camera is not None:
+                await asyncio.shield(
+                    loop.run_in_executor(None, stop_camera, camera))
+            writer.close()
+            if self.camera_task is asyncio.current_task():
+                self.camera_task = None
+
+        logger.info(colors.blue & colors.bold |
+                    'Stopped stream video to {}'
+                    .format(addr))
+
+    async def remote_control_handle(self, reader, writer):
+        logger = logging.getLogger('RemoteControlHandle')
+        addr = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        commands = {
+            OPCODES['fwd']: gopigo.fwd,
+            OPCODES['bwd']: gopigo.bwd,
+            OPCODES['left']: gopigo.left,
+            OPCODES['right']: gopigo.right,
+            OPCODES['stop']: gopigo.stop
+        }
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        logger.info(colors.blue & colors.bold |
+                    'Listening to remote control commands from {}'
+                    .format(addr))
+
+        try:
+            while True:
+                frame = await reader.readexactly(COMMAND_FRAME.size)
+                opcode, flags, argument, sequence = COMMAND_FRAME.unpack(
+                    frame)
+                command = commands.get(opcode)
+                if command is None:
+                    logger.warn(colors.yellow & colors.bold |
+                                'Unknown remote control opcode {}'
+                                .format(opcode))
+                    continue
+                received = time.perf_counter()
+                await loop.run_in_executor(self.hardware, command)
+                if flags & ACK_REQUESTED:
+                    apply_time = int((time.perf_counter() - received) * 1e6)
+                    writer.write(ACK_FRAME.pack(sequence, apply_time))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+        logger.warn(colors.yellow & colors.bold |
+                    'Stopped listening to remote control commands from {}'
+                    .format(addr))
+
+    async def ultrasonic_handle(self, reader, writer):
+        logger = logging.getLogger('UltrasonicHandle')
+        addr = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        samples = asyncio.Queue(maxsize=1)
+
+        def publish(sample):
+            # Latest sample wins if this client falls behind.
+            if samples.full():
+                samples.get_nowait()
+            samples.put_nowait(sample)
+
+        def on_sample(sample):
+            loop.call_soon_threadsafe(publish, sample)
+
+        logger.info(colors.blue & colors.bold |
+                    'Streaming ultrasonic distance to {}'
+                    .format(addr))
+
+        self.ultrasonic.subscribe(on_sample)
+        try:
+            while not writer.is_closing():
+                writer.write(TELEMETRY_SAMPLE.pack(*await samples.get()))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.ultrasonic.unsubscribe(on_sample)
+            writer.close()
+
+        logger.info(colors.blue & colors.bold |
+                    'Stopped streaming ultrasonic distance to {}'
+                    .format(addr))
 
 if __name__ == '__main__':
     main()
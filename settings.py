@@ -25,9 +25,99 @@ ROBOT_IP = '192.168.1.107'
 
 CAMERA_PORT = 8000
 ULTRASONIC_SENSOR_PORT = 8005
+ULTRASONIC_SENSOR_PIN = 15
+# Each reading takes about 80 ms, so the sensor tops out near 12 Hz. The
+# client receives the newest reading and the median of the last few.
+ULTRASONIC_SAMPLE_RATE = 10.0
+ULTRASONIC_HISTORY = 5
 REMOTE_CONTROL_PORT = 8010
 
+# 'smbus' drives the real GoPiGo board. 'simulated' drives an in-memory
+# GoPiGo instead, so the robot side runs on any Linux machine.
+GOPIGO_BUS = 'smbus'
+
+# Send only the newest remote control command when several are issued
+# faster than they can be sent.
+REMOTE_CONTROL_COALESCE = True
+# Ask the robot to acknowledge every command so the client can log
+# command round-trip and apply latency percentiles.
+REMOTE_CONTROL_ACKS = True
+
 CAMERA_FRAMERATE = 32
 CAMERA_RESOLUTION = (640, 480)
+# 'h264' streams encoded color video. 'luma' streams only the raw Y plane,
+# which the client reads straight into grayscale frames without decoding.
 CAMERA_VIDEO_FORMAT = 'h264'
 CAMERA_ROTATION = 180
+# Bytes of camera stream the robot holds for a slow client before it
+# disconnects it. Raw luma at 640x480 and 32 fps is about 9.8 MB/s.
+CAMERA_BUFFER_LIMIT = 4 * 1024 * 1024
+
+# Record the camera stream to this file (plus a '.idx' frame index), or
+# replay such a recording instead of connecting to the robot. Replay runs
+# in 'realtime' or, frame by frame as fast as analysis allows, 'fast'.
+RECORD_PATH = None
+REPLAY_PATH = None
+REPLAY_MODE = 'realtime'
+
+# Seconds the client waits for a new camera frame before warning.
+FRAME_TIMEOUT = 1.0
+# Number of preallocated frame buffers the client decodes into.
+FRAME_RING_DEPTH = 4
+
+# Seconds between the rolling per-stage latency reports of the client.
+PROFILER_REPORT_INTERVAL = 10.0
+
+# 'window' shows annotated frames from the main loop, 'threaded' shows
+# them from a separate thread (dropping stale ones) and 'headless' shows
+# nothing and takes keys from stdin. Only every Nth frame is rendered.
+DISPLAY_MODE = 'window'
+DISPLAY_RENDER_EVERY = 1
+
+# 'threads' runs the whole client loop in one process. 'processes' runs
+# capture, analysis and display in separate processes that pass frames
+# through a ring of PIPELINE_RING_DEPTH shared memory slots.
+PIPELINE_MODE = 'threads'
+PIPELINE_RING_DEPTH = 8
+
+# Number of threads evaluating the lane, speed sign and stop sign
+# detectors concurrently. Zero runs them serially on the main thread.
+ANALYSIS_WORKERS = 3
+
+# Haar cascade search window (x, y, w, h), smallest and largest sign size
+# (w, h) in full-frame pixels, and the factor the search window is shrunk
+# by before the cascade runs. None means the whole frame / no bound.
+STOP_SIGN_ROI = None
+STOP_SIGN_MIN_SIZE = (30, 30)
+STOP_SIGN_MAX_SIZE = (240, 240)
+STOP_SIGN_DOWNSCALE = 1.0
+
+SPEED_SIGN_ROI = None
+SPEED_SIGN_MIN_SIZE = (30, 30)
+SPEED_SIGN_MAX_SIZE = (240, 240)
+SPEED_SIGN_DOWNSCALE = 1.0
+
+# Run the sign cascades every N frames and track the signs in between.
+SIGN_DETECTION_INTERVAL = 4
+
+# Frames whose 32x24 thumbnail differs from that of the last frame the
+# sign cascades ran on by less than this many gray levels on average
+# reuse its sign detections, for at most SIGN_REUSE_MAX_AGE frames in a
+# row. None runs the sign detection on every frame.
+SIGN_CHANGE_THRESHOLD = 1.5
+SIGN_REUSE_MAX_AGE = 10
+
+# Per-frame processing time in seconds the client holds by trading sign
+# detection quality for speed, or None to keep the settings above fixed.
+# Ladder steps go from best quality to cheapest: (cascade scale factor,
+# detection downscale, sign detection interval).
+QUALITY_FRAME_BUDGET = None
+QUALITY_LADDER = [(1.3, 1.0, 4),
+                  (1.3, 1.5, 4),
+                  (1.4, 1.5, 6),
+                  (1.5, 2.0, 8),
+                  (1.6, 2.0, 12)]
+
+# Evaluate both sign cascades on a single shared image pyramid instead of
+# one pyramid per cascade. Sign ROIs, downscale and tracking are unused.
+SHARED_SIGN_PYRAMID = False
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Author: Gabriel Bustamante
+Email: gabrielbusta@gmail.com
+
+Selfdriving GoPiGo: An open source self-driving robot application.
+This app was built using the GoPiGo robotics platform for the Raspberry Pi.
+
+Copyright (C) 2017 Gabriel Bustamante
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+"""
+import time
+import logging
+from collections import namedtuple
+from threading import RLock
+from plumbum import colors
+import gopigo
+import settings
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Seconds each reading stays fresh. None keeps the first reading for the
+# lifetime of the process, for values the robot never changes.
+TTLS = {'voltage': 5.0,
+        'motor_speed': 0.5,
+        'distance': 0.1,
+        'firmware_version': None,
+        'board_revision': None}
+
+READERS = {'voltage': gopigo.volt_async,
+           'motor_speed': gopigo.read_motor_speed_async,
+           'distance': lambda: gopigo.corrected_us_dist_async(
+               settings.ULTRASONIC_SENSOR_PIN),
+           'firmware_version': gopigo.fw_ver_async,
+           'board_revision': gopigo.brd_rev_async}
+
+Telemetry = namedtuple('Telemetry', sorted(TTLS) + ['read_at'])
+
+
+class TelemetryCache(object):
+    # Caches robot readings so they can be looked at far more often than
+    # the firmware can answer. snapshot() never touches I2C: it returns
+    # every cached value at once, taken under one lock, and starts an
+    # asynchronous read for each field that went stale. `read_at` maps
+    # every field to the monotonic time its value was read, or None.
+    def __init__(self, ttls=None, readers=None):
+        self.ttls = dict(TTLS if ttls is None else ttls)
+        self.readers = dict(READERS if readers is None else readers)
+        # Reentrant: a reading that is already done calls store() at once.
+        self.lock = RLock()
+        self.values = {field: None for field in self.ttls}
+        self.read_at = {field: None for field in self.ttls}
+        self.refreshing = {}
+
+    def stale(self, field, now):
+        read_at = self.read_at[field]
+        if read_at is None:
+            return True
+        ttl = self.ttls[field]
+        return ttl is not None and now - read_at > ttl
+
+    def refresh_stale(self):
+        now = time.monotonic()
+        for field in self.ttls:
+            if field not in self.refreshing and self.stale(field, now):
+                self.refreshing[field] = self.readers[field]()
+                self.refreshing[field].add_done_callback(
+                    lambda reading, field=field: self.store(field, reading))
+
+    def store(self, field, reading):
+        # Runs on the I2C worker, so it only records the value.
+        try:
+            value = reading.result()
+        except Exception as ex:
+            logger.warn(colors.yellow & colors.bold |
+                        'Telemetry {} {}'.format(field, ex))
+            value = None
+        with self.lock:
+            del self.refreshing[field]
+            if value is not None:
+                self.values[field] = value
+                self.read_at[field] = time.monotonic()
+
+    def snapshot(self, wait=False):
+        # With `wait`, blocks until every field has been read at least once.
+        with self.lock:
+            self.refresh_stale()
+            pending = [reading for field, reading in self.refreshing.items()
+                       if self.read_at[field] is None]
+        if wait and pending:
+            for reading in pending:
+                reading.exception()
+            return self.snapshot()
+        with self.lock:
+            return Telemetry(read_at=dict(self.read_at), **self.values)
+
+    def get(self, field):
+        return getattr(self.snapshot(), field)
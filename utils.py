@@ -20,24 +20,79 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
 """
 import socket
+import struct
+import time
 import logging
 from plumbum import colors
-from threading import Thread
-from multiprocessing import Process, Queue, Event, queues
+from collections import deque
+from statistics import median
+from threading import Lock, Thread
+from multiprocessing import Condition, Process, Queue, Event, Value
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+# Raw luma frames are sent as a (width, height, length) header followed by
+# `length` bytes of 8-bit Y samples, one row after the other.
+LUMA_HEADER = struct.Struct('!HHI')
+
+# Remote control commands are fixed-size frames: opcode, flags, a signed
+# argument and a sequence number. When ACK_REQUESTED is set the robot
+# answers with the sequence number and how long applying the command
+# took, in microseconds.
+COMMAND_FRAME = struct.Struct('!BBhI')
+ACK_FRAME = struct.Struct('!II')
+ACK_REQUESTED = 0x01
+OPCODES = {'fwd': 1, 'bwd': 2, 'left': 3, 'right': 4, 'stop': 5}
+
+
+# Ultrasonic telemetry samples: the robot's monotonic timestamp (s), the
+# latest corrected distance and the median of recent distances (cm).
+TELEMETRY_SAMPLE = struct.Struct('!dhh')
+
+
+def receive_exactly(connection, size):
+    # Returns None if the peer closes the connection first.
+    data = bytearray(size)
+    view = memoryview(data)
+    while len(view):
+        received = connection.recv_into(view)
+        if not received:
+            return None
+        view = view[received:]
+    return data
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
 
 class RemoteControl(object):
-    def __init__(self, ip, port):
+    COMMANDS = ['fwd', 'bwd', 'left', 'right', 'stop']
+
+    def __init__(self, ip, port, coalesce=False, acknowledge=False):
         self.ip = ip
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.command_queue = Queue()
         self.shutdown_request = Event()
 
+        # In coalescing mode only the newest command is kept: a burst of
+        # calls between two sends collapses to the last one.
+        self.coalesce = coalesce
+        self.command_ready = Condition()
+        self.latest_command = Value('b', -1, lock=False)
+
+        # With acknowledgements on, the sender measures each command's
+        # round trip and the robot reports how long applying it took.
+        self.acknowledge = acknowledge
+        self.sent_times = {}
+        self.round_trips = []
+        self.apply_times = []
+
     def start(self):
         try:
             self.socket.connect((self.ip, self.port))
@@ -52,35 +107,99 @@ class RemoteControl(object):
         self.process.start()
         return self
 
+    def next_command(self):
+        # Blocks until there is a command to send. Returns None once a
+        # shutdown was requested and nothing is left to send.
+        if not self.coalesce:
+            return self.command_queue.get()
+
+        with self.command_ready:
+            self.command_ready.wait_for(
+                lambda: (self.latest_command.value >= 0 or
+                         self.shutdown_request.is_set()))
+            if self.latest_command.value < 0:
+                return None
+            command = self.COMMANDS[self.latest_command.value]
+            self.latest_command.value = -1
+        return command
+
     def send_commands(self):
-        while not self.shutdown_request.is_set():
+        if self.acknowledge:
+            Thread(target=self.receive_acks, daemon=True).start()
+
+        flags = ACK_REQUESTED if self.acknowledge else 0
+        sequence = 0
+        while True:
+            command = self.next_command()
+            if command is None:
+                break
+            sequence += 1
+            if self.acknowledge:
+                self.sent_times[sequence] = time.perf_counter()
+            self.socket.sendall(COMMAND_FRAME.pack(OPCODES[command], flags,
+                                                   0, sequence))
+
+        if self.round_trips:
+            self.log_latency()
+
+    def receive_acks(self):
+        while True:
             try:
-                command = self.command_queue.get(block=False)
-                self.socket.send(command)
-            except queues.Empty:
-                continue
+                ack = receive_exactly(self.socket, ACK_FRAME.size)
+            except OSError:
+                return
+            if ack is None:
+                return
+            sequence, apply_time = ACK_FRAME.unpack(ack)
+            sent = self.sent_times.pop(sequence, None)
+            if sent is not None:
+                self.round_trips.append(time.perf_counter() - sent)
+                self.apply_times.append(apply_time / 1e6)
+
+    def log_latency(self):
+        round_trips = list(self.round_trips)
+        apply_times = list(self.apply_times)
+        logger.info(colors.blue & colors.bold |
+                    'RemoteControl: {} commands acknowledged, '
+                    'round trip p50/p95/p99 = {:.1f}/{:.1f}/{:.1f} ms, '
+                    'apply p50/p95/p99 = {:.1f}/{:.1f}/{:.1f} ms'
+                    .format(len(round_trips),
+                            *[percentile(samples, fraction) * 1e3
+                              for samples in (round_trips, apply_times)
+                              for fraction in (0.5, 0.95, 0.99)]))
+
+    def send(self, command):
+        if not self.coalesce:
+            self.command_queue.put(command)
+            return
+        with self.command_ready:
+            self.latest_command.value = self.COMMANDS.index(command)
+            self.command_ready.notify()
 
     def shutdown(self):
-        self.socket.send(''.encode())
         self.shutdown_request.set()
+        # Wake the sender so it can drain what is left and exit.
+        self.command_queue.put(None)
+        with self.command_ready:
+            self.command_ready.notify()
         self.process.join()
         self.socket.shutdown(socket.SHUT_RDWR)
         self.socket.close()
 
     def fwd(self):
-        self.command_queue.put('fwd'.encode())
+        self.send('fwd')
 
     def bwd(self):
-        self.command_queue.put('bwd'.encode())
+        self.send('bwd')
 
     def left(self):
-        self.command_queue.put('left'.encode())
+        self.send('left')
 
     def right(self):
-        self.command_queue.put('right'.encode())
+        self.send('right')
 
     def stop(self):
-        self.command_queue.put('stop'.encode())
+        self.send('stop')
 
 
 class Server(object):
@@ -130,3 +249,153 @@ class Task(Thread):
     def join(self):
         super().join()
         return self._result
+
+
+class LumaFrameWriter(object):
+    # File-like output for PiCamera.start_recording(format='yuv'). The
+    # camera writes padded YUV420 frames; only the Y plane is forwarded.
+    def __init__(self, stream, resolution):
+        self.stream = stream
+        self.width, self.height = resolution
+        self.padded_width = (self.width + 31) // 32 * 32
+        self.padded_height = (self.height + 15) // 16 * 16
+        self.frame_size = self.padded_width * self.padded_height * 3 // 2
+        self.pending = bytearray()
+
+    def write(self, data):
+        if not self.pending and len(data) == self.frame_size:
+            self.send_frame(memoryview(data))
+            return len(data)
+
+        self.pending.extend(data)
+        while len(self.pending) >= self.frame_size:
+            with memoryview(self.pending) as view:
+                self.send_frame(view[:self.frame_size])
+            del self.pending[:self.frame_size]
+        return len(data)
+
+    def send_frame(self, frame):
+        if self.padded_width == self.width:
+            self.send_luma(frame[:self.width * self.height])
+        else:
+            self.send_luma(b''.join(
+                frame[row * self.padded_width:
+                      row * self.padded_width + self.width]
+                for row in range(self.height)))
+
+    def send_luma(self, luma):
+        self.stream.write(LUMA_HEADER.pack(self.width, self.height,
+                                           len(luma)))
+        self.stream.write(luma)
+        self.stream.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+
+class UltrasonicSampler(Thread):
+    # Polls `read` (a blocking distance reading) at a fixed rate on its own
+    # thread, keeps the last `history` readings and passes every
+    # (timestamp, distance, median distance) sample to the subscribers.
+    def __init__(self, read, rate=10.0, history=5):
+        super().__init__(name='UltrasonicSampler', daemon=True)
+        self.read = read
+        self.period = 1.0 / rate
+        self.history = deque(maxlen=history)
+        self.subscribers = []
+        self.lock = Lock()
+        self.latest = None
+        self.shutdown_request = False
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.remove(callback)
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self.shutdown_request:
+            try:
+                distance = self.read()
+            except Exception as ex:
+                logger.warn(colors.yellow & colors.bold |
+                            'UltrasonicSampler {}'.format(ex))
+                distance = -1
+            if distance >= 0:
+                self.history.append(distance)
+            filtered = int(median(self.history)) if self.history else -1
+            sample = (time.monotonic(), distance, filtered)
+
+            with self.lock:
+                self.latest = sample
+                subscribers = list(self.subscribers)
+            for callback in subscribers:
+                callback(sample)
+
+            # Fixed rate: skip missed periods instead of bursting.
+            deadline += self.period
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            time.sleep(deadline - now)
+
+    def shutdown(self):
+        self.shutdown_request = True
+        self.join()
+
+
+class UltrasonicSubscriber(object):
+    # Client side of the ultrasonic telemetry stream. A background thread
+    # keeps the newest sample; read() never blocks.
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.lock = Lock()
+        self.sample = None
+        self.received = None
+
+    def start(self):
+        try:
+            self.socket.connect((self.ip, self.port))
+        except Exception as ex:
+            logger.error(colors.red |
+                        'UltrasonicSubscriber {}. Run "servers.py" on the '
+                        'GoPiGo!'.format(ex))
+            exit(1)
+
+        self.thread = Thread(target=self.receive_samples, daemon=True)
+        self.thread.start()
+        return self
+
+    def receive_samples(self):
+        while True:
+            try:
+                data = receive_exactly(self.socket, TELEMETRY_SAMPLE.size)
+            except OSError:
+                return
+            if data is None:
+                return
+            with self.lock:
+                self.sample = TELEMETRY_SAMPLE.unpack(data)
+                self.received = time.monotonic()
+
+    def read(self):
+        # Returns (distance, median distance, age in seconds) of the newest
+        # sample, or None before the first one arrives.
+        with self.lock:
+            if self.sample is None:
+                return None
+            _, distance, filtered = self.sample
+            return distance, filtered, time.monotonic() - self.received
+
+    def shutdown(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.thread.join()